@@ -3,11 +3,19 @@
 import xbmc
 import xbmcgui
 import requests
+import xrpc
+import handles
+import graph
+import store
+import history
+import outbox
 import os
 import sys
 import json
 import datetime
 import re
+import threading
+from collections import OrderedDict
 from datetime import timedelta
 import time
 
@@ -15,7 +23,27 @@ import time
 BASE_URL = 'https://bsky.social/xrpc/'
 CHAT_URL = 'https://api.bsky.chat/xrpc/'
 GAMES_FILE = xbmc.translatePath('Q://games.txt')
-HANDLES_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/handles.txt'.format(xbmc.getInfoLabel('System.ProfileName')))
+CONVO_INDEX_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/convo_index.json'.format(xbmc.getInfoLabel('System.ProfileName')))
+CONVERSATIONS_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/conversations.json'.format(xbmc.getInfoLabel('System.ProfileName')))
+NOTIFICATIONS_PAGE_SIZE = 50  # Notifications shown before "Load More"
+BEACON_SEARCH_LIMIT = 100  # Max posts scanned for beacons per search
+POSTS_BATCH = 25  # Max URIs per app.bsky.feed.getPosts call
+POST_TEXT_CACHE_SIZE = 500  # Post texts kept in memory between visits to the notifications screen
+APPLY_WRITES_BATCH = 50  # Max follow/block writes per com.atproto.repo.applyWrites call
+MESSAGES_PAGE_SIZE = 50  # Messages per getMessages call, also the size of a "Load Older" page
+MESSAGE_SYNC_PAGES = 5  # Newest pages fetched to catch up with the stored history before starting it over
+OUTBOX_EXIT_WAIT = 10  # Seconds to keep delivering queued messages after the user leaves the script
+VIEW_MAX_AGE = 60  # Seconds a screen re-shows its data from memory before refreshing it in the background
+FEED_PAGE_SIZE = 25  # Posts per home feed page
+FEED_CACHE_PAGES = 10  # Home feed pages kept in memory
+FEED_CACHE_AGE = 300  # Seconds a cached home feed page is shown before it is fetched again
+
+_post_texts = OrderedDict()  # Post URI -> text, most recently used last
+_post_texts_lock = threading.Lock()
+_feed_pages = OrderedDict()  # Timeline cursor ('' for the first page) -> (fetched at, feed, next cursor)
+_feed_prefetch = {}  # Timeline cursor -> thread fetching that page
+_feed_state = {'generation': 0}  # Bumped on invalidation so in-flight prefetches don't store stale pages
+_feed_lock = threading.Lock()
 
 # Load login credentials
 def load_credentials():
@@ -27,202 +55,291 @@ def load_credentials():
                 return lines[0].strip(), lines[1].strip()
     return None, None
 
-# Authenticate with BlueSky
+# Authenticate with BlueSky, reusing the saved session when possible
 def authenticate(username, app_password):
-    url = BASE_URL + 'com.atproto.server.createSession'
-    data = {'identifier': username, 'password': app_password}
     try:
-        response = requests.post(url, json=data)
-        response.raise_for_status()
-        return response.json()
+        return xrpc.resume_session(BASE_URL, username, app_password)
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok('Cortana Chat', 'Authentication failed: ' + str(e))
         return None
 
-# Fetch home feed
-def fetch_home_feed(session, cursor=None):
+# Fetch a home feed page, raising on network errors
+def request_home_feed(session, cursor=None, priority=xrpc.PRIORITY_NORMAL):
     url = BASE_URL + 'app.bsky.feed.getTimeline'
-    headers = {'Authorization': 'Bearer ' + session['accessJwt']}
-    params = {'limit': 25}
+    params = {'limit': FEED_PAGE_SIZE}
     if cursor:
         params['cursor'] = cursor
-    
+
+    response = xrpc.get(session, url, params=params, priority=priority)
+    response.raise_for_status()
+    data = response.json()
+    feed = data.get('feed', [])
+    next_cursor = data.get('cursor', None)
+
+    # Timeline authors (and reposters) already carry their handles
+    authors = [post['post']['author'] for post in feed if 'post' in post and 'author' in post['post']]
+    authors += [post['reason']['by'] for post in feed if 'by' in post.get('reason', {})]
+    normalize_profiles(session, authors)
+
+    return feed, next_cursor
+
+# Fetch home feed
+def fetch_home_feed(session, cursor=None):
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
-        feed = data.get('feed', [])
-        next_cursor = data.get('cursor', None)
-        
-        dids = {post['post']['author']['did'] for post in feed if 'post' in post and 'author' in post['post'] and 'did' in post['post']['author']}
-        profiles = fetch_profiles(session, dids)
-        
-        for post in feed:
-            author = post.get('post', {}).get('author', {})
-            if 'did' in author:
-                author['handle'] = profiles.get(author['did'], 'Unknown')
-        
-        return feed, next_cursor
+        return request_home_feed(session, cursor)
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok('Cortana Chat', 'Failed to fetch home feed: ' + str(e))
         return [], None
 
-# Fetch user profile to resolve handle
-def fetch_profile(session, did):
-    handle = read_handle_from_file(did)
-    if handle:
-        return handle
-    
-    url = BASE_URL + 'app.bsky.actor.getProfile'
-    headers = {'Authorization': 'Bearer ' + session['accessJwt']}
-    params = {'actor': did}
-    try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        handle = response.json().get('handle', 'Unknown')
-        write_handle_to_file(did, handle)
-        return handle
-    except requests.exceptions.RequestException:
-        return 'Unknown'
-
-# Fetch user profiles in bulk
+# Remember a fetched home feed page, dropping the oldest pages beyond FEED_CACHE_PAGES
+def _cache_home_feed(key, page, generation):
+    with _feed_lock:
+        if generation != _feed_state['generation']:
+            return
+        _feed_pages.pop(key, None)
+        _feed_pages[key] = (time.time(), page[0], page[1])
+        while len(_feed_pages) > FEED_CACHE_PAGES:
+            _feed_pages.popitem(last=False)
+
+# Get a home feed page from the cache, waiting for its prefetch if one is running
+def get_home_feed_page(session, cursor=None):
+    key = cursor or ''
+    with _feed_lock:
+        prefetch = _feed_prefetch.get(key)
+    if prefetch:
+        prefetch.join()
+
+    with _feed_lock:
+        cached = _feed_pages.get(key)
+        generation = _feed_state['generation']
+    if cached and time.time() - cached[0] < FEED_CACHE_AGE:
+        return cached[1], cached[2]
+
+    page = fetch_home_feed(session, cursor)
+    if page[0]:
+        _cache_home_feed(key, page, generation)
+    return page
+
+# Fetch a home feed page in the background so "Next Page" shows it instantly
+def prefetch_home_feed(session, cursor):
+    key = cursor or ''
+    with _feed_lock:
+        cached = _feed_pages.get(key)
+        if key in _feed_prefetch or (cached and time.time() - cached[0] < FEED_CACHE_AGE):
+            return
+        generation = _feed_state['generation']
+
+        def fetch_page():
+            try:
+                _cache_home_feed(key, request_home_feed(session, cursor, xrpc.PRIORITY_LOW), generation)
+            except requests.exceptions.RequestException as e:
+                xbmc.log("Cortana Chat: Failed to prefetch home feed. Error: {}".format(str(e)), xbmc.LOGERROR)
+            finally:
+                with _feed_lock:
+                    if _feed_prefetch.get(key) is prefetch:
+                        del _feed_prefetch[key]
+
+        prefetch = threading.Thread(target=fetch_page)
+        prefetch.daemon = True
+        _feed_prefetch[key] = prefetch
+    prefetch.start()
+
+# Forget cached home feed pages, e.g. after posting so the new post shows up
+def invalidate_home_feed():
+    with _feed_lock:
+        _feed_state['generation'] += 1
+        _feed_pages.clear()
+        _feed_prefetch.clear()
+
+# Fetch user profiles in bulk, 25 per getProfiles call
 def fetch_profiles(session, dids):
-    profiles = {}
-    for did in dids:
-        profiles[did] = fetch_profile(session, did)
-    return profiles
-
-# Read handle from file
-def read_handle_from_file(did):
-    if os.path.exists(HANDLES_FILE):
-        with open(HANDLES_FILE, 'r') as f:
-            for line in f:
-                stored_did, handle = line.strip().split(',')
-                if stored_did == did:
-                    return handle
-    return None
-
-# Write handle to file
-def write_handle_to_file(did, handle):
-    with open(HANDLES_FILE, 'a') as f:
-        f.write('{},{}\n'.format(did, handle))
-
-# Fetch notifications
-def fetch_notifications(session):
+    return handles.resolve(session, BASE_URL, dids)
+
+# Seed the handle cache from embedded profile views, resolving only the ones without a handle
+def normalize_profiles(session, views):
+    views = [view for view in views if 'did' in view]
+    handles.seed(views)
+    missing = {view['did'] for view in views if not view.get('handle')}
+    if missing:
+        profiles = fetch_profiles(session, missing)
+        for view in views:
+            if not view.get('handle'):
+                view['handle'] = profiles.get(view['did'], 'Unknown')
+    return views
+
+# Stream notifications page by page
+def iter_notifications(session, limit=None):
     url = BASE_URL + 'app.bsky.notification.listNotifications'
-    headers = {'Authorization': 'Bearer ' + session['accessJwt']}
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        return response.json().get('notifications', [])
-    except requests.exceptions.RequestException as e:
-        xbmcgui.Dialog().ok('Cortana Chat', 'Failed to fetch notifications: ' + str(e))
-        return []
+    for page in xrpc.iter_pages(session, url, 'notifications', limit=limit, page_size=NOTIFICATIONS_PAGE_SIZE):
+        handles.seed([n['author'] for n in page if 'author' in n])
+        yield page
 
-# Fetch followers
-def fetch_followers(session):
+# Stream followers page by page
+def iter_followers(session, limit=None):
     url = BASE_URL + 'app.bsky.graph.getFollowers'
-    headers = {'Authorization': 'Bearer ' + session['accessJwt']}
     params = {'actor': session['handle']}
-    try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        return response.json().get('followers', [])
-    except requests.exceptions.RequestException as e:
-        xbmcgui.Dialog().ok('Cortana Chat', 'Failed to fetch followers: ' + str(e))
-        return []
+    for page in xrpc.iter_pages(session, url, 'followers', params, limit):
+        handles.seed(page)
+        yield page
 
-# Fetch following
-def fetch_following(session):
+# Stream following page by page
+def iter_following(session, limit=None):
     url = BASE_URL + 'app.bsky.graph.getFollows'
-    headers = {'Authorization': 'Bearer ' + session['accessJwt']}
     params = {'actor': session['handle']}
+    for page in xrpc.iter_pages(session, url, 'follows', params, limit):
+        handles.seed(page)
+        yield page
+
+# Stream blocked users page by page
+def iter_blocked_users(session, limit=None):
+    url = BASE_URL + "app.bsky.graph.getBlocks"
+    for page in xrpc.iter_pages(session, url, "blocks", limit=limit):
+        handles.seed(page)
+        yield page
+
+# Bring one set of the local graph up to date; lists are newest first, so an incremental sync stops at the first page with nothing new
+def sync_graph(session, name, iter_pages):
+    graph.set_owner(session['did'])
+    if graph.is_fresh(name):
+        return True
+    full = graph.needs_full_sync(name)
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        return response.json().get('follows', [])
+        if full:
+            graph.replace(name, [p for page in iter_pages(session) for p in page])
+        else:
+            for page in iter_pages(session):
+                if graph.merge_page(name, page) < len(page):
+                    break
+        graph.mark_synced(name, full)
+        graph.save()
+        return True
     except requests.exceptions.RequestException as e:
-        xbmcgui.Dialog().ok('Cortana Chat', 'Failed to fetch following: ' + str(e))
-        return []
+        xbmcgui.Dialog().ok('Cortana Chat', 'Failed to sync ' + name + ': ' + str(e))
+        return False
 
 def fetch_mutuals(session):
-    followers = {f.get('did') for f in fetch_followers(session)}
-    following = {f.get('did') for f in fetch_following(session)}
+    sync_graph(session, 'followers', iter_followers)
+    sync_graph(session, 'following', iter_following)
+    return graph.mutuals()
 
-    mutual_dids = followers.intersection(following)
+# Fetch conversations with proper user handles in bulk, raising on network errors
+def request_conversations(session):
+    url = CHAT_URL + 'chat.bsky.convo.listConvos'
+    response = xrpc.get(session, url)
+    response.raise_for_status()
+    conversations = response.json().get('convos', [])
 
-    # Resolve handles for mutuals
-    mutuals = []
-    for did in mutual_dids:
-        handle = fetch_profile(session, did)
-        mutuals.append(handle)
+    # Members already carry their handles, which also covers the message senders later
+    normalize_profiles(session, [participant for convo in conversations for participant in convo.get('members', [])])
 
-    return mutuals
+    for convo in conversations:
+        participants = convo.get('members', [])
+        convo['user_handle'] = next(
+            (p['handle'] for p in participants if p['handle'] != session['handle']),
+            'Unknown'
+        )
 
-def fetch_blocked_users(session):
-    url = BASE_URL + "app.bsky.graph.getBlocks"
-    headers = {"Authorization": "Bearer " + session["accessJwt"]}
-
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        return response.json().get("blocks", [])
-    except requests.exceptions.RequestException as e:
-        xbmcgui.Dialog().ok("Error", "Failed to fetch blocked users: " + str(e))
-        return []
+    save_cached_conversations(session, conversations)
+    index_conversations(session, conversations)
+    return conversations
 
 # Fetch conversations with proper user handles in bulk
 def fetch_conversations(session):
-    url = CHAT_URL + 'chat.bsky.convo.listConvos'
-    headers = {'Authorization': 'Bearer ' + session['accessJwt']}
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        conversations = response.json().get('convos', [])
-        
-        # Collect all unique DIDs to fetch in bulk
-        dids = {participant['did'] for convo in conversations for participant in convo.get('members', []) if 'did' in participant}
-        profiles = {did: fetch_profile(session, did) for did in dids}
-        
-        # Assign resolved handles to conversations
-        for convo in conversations:
-            participants = convo.get('members', [])
-            for participant in participants:
-                if 'did' in participant:
-                    participant['handle'] = profiles.get(participant['did'], 'Unknown')
-            convo['user_handle'] = next(
-                (p['handle'] for p in participants if p['handle'] != session['handle']),
-                'Unknown'
-            )
-        
-        return conversations
+        return request_conversations(session)
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok('Cortana Chat', 'Failed to fetch conversations: ' + str(e))
         return []
 
-# Fetch messages for a conversation
-def fetch_messages(session, convo_id):
+# Keep only the conversation fields the Chat screen needs, so conversations.json stays small
+def summarize_conversation(convo):
+    last_message = convo.get('lastMessage', {})
+    return {
+        'id': convo.get('id'),
+        'rev': convo.get('rev'),
+        'unreadCount': convo.get('unreadCount', 0),
+        'user_handle': convo.get('user_handle', 'Unknown'),
+        'members': [{'did': m.get('did'), 'handle': m.get('handle')} for m in convo.get('members', [])],
+        'lastMessage': {'id': last_message.get('id'), 'text': last_message.get('text', 'No message')} if last_message else {},
+    }
+
+# Save the last conversation list so the Chat screen can open from disk
+def save_cached_conversations(session, conversations):
+    store.save_json(CONVERSATIONS_FILE, {'owner': session['did'], 'convos': [summarize_conversation(c) for c in conversations]})
+
+# Load the conversation list saved by the last visit, or None if there isn't one for this account
+def load_cached_conversations(session):
+    saved = store.load_json(CONVERSATIONS_FILE, {})
+    if saved.get('owner') != session['did']:
+        return None
+    return saved.get('convos')
+
+# Load the DID/handle -> conversation ID index, empty if it belongs to another account
+def load_convo_index(session):
+    saved = store.load_json(CONVO_INDEX_FILE, {})
+    if saved.get('owner') != session['did']:
+        return {}
+    return saved.get('convos', {})
+
+# Add the one-to-one conversations of a listing to the index, keyed by the other member's DID and handle
+def index_conversations(session, conversations):
+    index = load_convo_index(session)
+    for convo in conversations:
+        others = [m for m in convo.get('members', []) if m.get('did') != session['did']]
+        if len(others) != 1 or not convo.get('id'):
+            continue
+        index[others[0]['did']] = convo['id']
+        if others[0].get('handle'):
+            index[others[0]['handle']] = convo['id']
+    store.save_json(CONVO_INDEX_FILE, {'owner': session['did'], 'convos': index})
+
+# Fetch a page of messages for a conversation, newest first, raising on network errors
+def request_messages(session, convo_id, cursor=None):
     url = CHAT_URL + 'chat.bsky.convo.getMessages'
-    headers = {'Authorization': 'Bearer ' + session['accessJwt']}
-    params = {'convoId': convo_id}
-    try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        messages = response.json().get('messages', [])
-        
-        # Collect all unique DIDs to fetch in bulk
-        dids = {message['sender']['did'] for message in messages if 'sender' in message and 'did' in message['sender']}
-        profiles = {did: fetch_profile(session, did) for did in dids}
-        
-        # Assign resolved handles to messages
-        for message in messages:
-            if 'sender' in message and 'did' in message['sender']:
-                message['sender']['handle'] = profiles.get(message['sender']['did'], 'Unknown')
-        
-        return messages
-    except requests.exceptions.RequestException as e:
-        xbmcgui.Dialog().ok('Cortana Chat', 'Failed to fetch messages: ' + str(e))
-        return []
+    params = {'convoId': convo_id, 'limit': MESSAGES_PAGE_SIZE}
+    if cursor:
+        params['cursor'] = cursor
+    response = xrpc.get(session, url, params=params)
+    response.raise_for_status()
+    data = response.json()
+    messages = data.get('messages', [])
+
+    # Senders only carry a DID, so fill their handles from the cache or the network
+    normalize_profiles(session, [message['sender'] for message in messages if 'sender' in message])
+
+    return messages, data.get('cursor')
+
+# Bring the stored history up to date, fetching only messages newer than its head
+def sync_messages(session, convo_id):
+    head = history.head_id(convo_id)
+    newer = []
+    cursors = {}  # Oldest message of each full page -> cursor for the page before it
+    cursor = None
+    joined = False
+    for _ in range(MESSAGE_SYNC_PAGES if head else 1):
+        page, cursor = request_messages(session, convo_id, cursor)
+        for message in page:
+            if head and message.get('id', '') <= head:  # Message IDs are TIDs, so they sort by time
+                joined = True
+                break
+            newer.append(message)
+        if joined or not cursor:
+            break
+        if page:
+            cursors[page[-1].get('id')] = cursor
+
+    if head and (joined or not cursor):
+        history.add_newer(convo_id, newer, cursors)
+    else:
+        # Empty history, or too many new messages to join up with the stored ones
+        history.reset(convo_id, newer, cursor)
+    return history.load(convo_id)
+
+# Fetch the page before the oldest stored message and add it to the history
+def load_older_messages(session, convo_id, cursor):
+    page, next_cursor = request_messages(session, convo_id, cursor)
+    history.add_older(convo_id, page, next_cursor, cursor)
+    return history.load(convo_id)
 
 # Create a new post
 def create_post(session):
@@ -245,18 +362,16 @@ def create_post(session):
         }
 
         url = BASE_URL + 'com.atproto.repo.createRecord'
-        headers = {
-            'Authorization': 'Bearer ' + session['accessJwt']
-        }
         data = {
             'repo': session['did'],
             'collection': 'app.bsky.feed.post',
             'record': post
         }
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = xrpc.post(session, url, json=data)
             response.raise_for_status()  # Raise an error for bad status codes
             xbmc.executebuiltin("Notification(Cortana Chat, Post created successfully!, 5000)")
+            invalidate_home_feed()
         except requests.exceptions.RequestException as e:
             xbmc.executebuiltin("Notification(Cortana Chat, Failed to create post. Error: " + str(e) + ", 5000)")
 
@@ -296,7 +411,7 @@ def create_post_media(session):
             if len(img_bytes) > 1000000:
                 xbmcgui.Dialog().ok('Cortana Chat', 'Image file size too large. 1000000 bytes (1MB) maximum, got: {}'.format(len(img_bytes)))
                 return
-            blob = upload_file(BASE_URL, session['accessJwt'], image_path, img_bytes)
+            blob = upload_file(BASE_URL, session, image_path, img_bytes)
             images.append({"alt": "", "image": blob})
 
         post = {
@@ -311,18 +426,16 @@ def create_post_media(session):
         }
 
         url = BASE_URL + 'com.atproto.repo.createRecord'
-        headers = {
-            'Authorization': 'Bearer ' + session['accessJwt']
-        }
         data = {
             'repo': session['did'],
             'collection': 'app.bsky.feed.post',
             'record': post
         }
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = xrpc.post(session, url, json=data)
             response.raise_for_status()  # Raise an error for bad status codes
             xbmc.executebuiltin("Notification(Cortana Chat, Post created successfully!, 5000)")
+            invalidate_home_feed()
         except requests.exceptions.RequestException as e:
             xbmc.executebuiltin("Notification(Cortana Chat, Failed to create post. Error: " + str(e) + ", 5000)")
 
@@ -348,18 +461,16 @@ def create_post_invite(session):
         }
 
         url = BASE_URL + 'com.atproto.repo.createRecord'
-        headers = {
-            'Authorization': 'Bearer ' + session['accessJwt']
-        }
         data = {
             'repo': session['did'],
             'collection': 'app.bsky.feed.post',
             'record': post
         }
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = xrpc.post(session, url, json=data)
             response.raise_for_status()
             xbmc.executebuiltin("Notification(Cortana Chat, Beacon for " + game_title + " posted successfully!, 5000)")
+            invalidate_home_feed()
         except requests.exceptions.RequestException as e:
             xbmc.executebuiltin("Notification(Cortana Chat, Failed to post beacon: " + str(e) + ", 5000)")
 
@@ -368,7 +479,6 @@ def search_for_beacon(session, game_title=None):
     games = load_games()
     
     url = BASE_URL + "app.bsky.feed.searchPosts"
-    headers = {'Authorization': 'Bearer ' + session['accessJwt']}
     
     if game_title:
         params = {'q': "would like to play '{}' (Xbox)".format(game_title)}
@@ -376,9 +486,7 @@ def search_for_beacon(session, game_title=None):
         params = {'q': "would like to play"}
     
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        posts = response.json().get("posts", [])
+        posts = list(xrpc.paginate(session, url, "posts", params, BEACON_SEARCH_LIMIT))
         
         results = ["Search For Game"]
         post_data = []
@@ -428,7 +536,7 @@ def search_for_beacon(session, game_title=None):
 
 
 # Function to upload files
-def upload_file(base_url, access_token, filename, img_bytes):
+def upload_file(base_url, session, filename, img_bytes):
     suffix = filename.split(".")[-1].lower()
     mimetype = "application/octet-stream"
     if suffix in ["png"]:
@@ -438,12 +546,10 @@ def upload_file(base_url, access_token, filename, img_bytes):
     elif suffix in ["webp"]:
         mimetype = "image/webp"
 
-    resp = requests.post(
+    resp = xrpc.post(
+        session,
         base_url + "com.atproto.repo.uploadBlob",
-        headers={
-            "Content-Type": mimetype,
-            "Authorization": "Bearer " + access_token,
-        },
+        headers={"Content-Type": mimetype},
         data=img_bytes,
     )
     resp.raise_for_status()
@@ -517,7 +623,7 @@ def display_menu(session):
 def display_friends_menu(session):
     while True:
         dialog = xbmcgui.Dialog()
-        options = ["Followers", "Following", "Mutuals", "Blocked", "Follow User", "Block User"]
+        options = ["Followers", "Following", "Mutuals", "Blocked", "Follow User", "Block User", "Bulk Actions"]
         choice = dialog.select("Friends", options)
         
         if choice == -1:
@@ -534,21 +640,91 @@ def display_friends_menu(session):
             follow_user(session)
         elif choice == 5:
             block_user(session)
+        elif choice == 6:
+            display_bulk_menu(session)
 
-def get_did_from_handle(session, handle):
-    """Fetches the DID of a user from their handle."""
-    url = BASE_URL + "app.bsky.actor.getProfile?actor=" + handle
-    headers = {"Authorization": "Bearer " + session["accessJwt"]}
+# Display bulk follow / block menu
+def display_bulk_menu(session):
+    while True:
+        dialog = xbmcgui.Dialog()
+        options = ["Follow Back All Followers", "Unfollow Non-Followers", "Follow Users (List)", "Block Users (List)"]
+        choice = dialog.select("Bulk Actions", options)
+
+        if choice == -1:
+            return  # User backed out
+        elif choice == 0:
+            follow_back_all(session)
+        elif choice == 1:
+            unfollow_non_followers(session)
+        elif choice == 2:
+            bulk_from_handle_list(session, "follow")
+        elif choice == 3:
+            bulk_from_handle_list(session, "block")
+
+# Resolve a user's DID and our follow / block record URIs from one getProfile call
+def get_relationship(session, handle):
+    url = BASE_URL + "app.bsky.actor.getProfile"
+    params = {"actor": handle}
 
     try:
-        response = requests.get(url, headers=headers)
+        response = xrpc.get(session, url, params=params)
         response.raise_for_status()
-        return response.json().get("did")  # Extract DID
+        profile = response.json()
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok("Error", "Could not find DID for @" + handle + ": " + str(e))
         return None
 
-def follow_user(session, handle=None):
+    handles.seed([profile])
+    viewer = profile.get("viewer")
+    relationship = {"did": profile.get("did"), "viewer": viewer is not None}
+    changed = False
+    for name, key in graph.VIEWER_KEYS.items():
+        relationship[name] = (viewer or {}).get(key)
+        if relationship[name] and relationship["did"] and graph.record_uri(name, relationship["did"]) != relationship[name]:
+            graph.set_record_uri(name, relationship["did"], relationship[name])
+            changed = True
+    if changed:
+        graph.save()
+    return relationship
+
+def get_did_from_handle(session, handle):
+    """Fetches the DID of a user from their handle."""
+    relationship = get_relationship(session, handle)
+    return relationship["did"] if relationship else None
+
+# Find a user's DID and our record URI for a set: cached first, then getProfile viewer state, then a listRecords scan
+def resolve_relationship_record(session, handle, name):
+    did = graph.did_for_handle(name, handle)
+    uri = graph.record_uri(name, did) if did else None
+    if uri:
+        return did, uri
+
+    relationship = get_relationship(session, handle)
+    if not relationship or not relationship["did"]:
+        return None, None
+    did = relationship["did"]
+    if relationship["viewer"]:
+        return did, relationship[name]
+
+    # The response carried no viewer state, so fall back to scanning our own records
+    if name == "following":
+        return did, get_follow_record_uri(session, did)
+    return did, get_block_record_uri(session, did, handle)
+
+# Index all of our records in a collection by subject DID, paging through listRecords
+def index_record_uris(session, name, collection):
+    url = BASE_URL + "com.atproto.repo.listRecords"
+    params = {
+        "repo": session["did"],  # Your own repository
+        "collection": collection
+    }
+    for record in xrpc.paginate(session, url, "records", params):
+        subject = record.get("value", {}).get("subject")
+        if subject and "uri" in record:
+            graph.set_record_uri(name, subject, record["uri"])
+    graph.save()
+
+def follow_user(session, handle=None, did=None):
     if handle is None:  # If no handle is given, ask for one
         keyboard = xbmc.Keyboard("", "Enter the handle of the user to follow")
         keyboard.doModal()
@@ -559,12 +735,12 @@ def follow_user(session, handle=None):
         xbmcgui.Dialog().ok("Error", "No handle entered.")
         return
 
-    did = get_did_from_handle(session, handle)
+    if not did:
+        did = get_did_from_handle(session, handle)
     if not did:
         return  # Stop if DID lookup fails
 
     url = BASE_URL + "com.atproto.repo.createRecord"
-    headers = {"Authorization": "Bearer " + session["accessJwt"]}
     data = {
         "repo": session["did"],  # Your own DID (not the target user)
         "collection": "app.bsky.graph.follow",
@@ -576,76 +752,48 @@ def follow_user(session, handle=None):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = xrpc.post(session, url, json=data)
         response.raise_for_status()
+        graph.add('following', did, handle, response.json().get("uri"))
+        graph.save()
         xbmcgui.Dialog().ok("Success", "You are now following @" + handle)
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok("Error", "Failed to follow @" + handle + ": " + str(e))
 
 def get_follow_record_uri(session, did):
-    url = BASE_URL + "com.atproto.repo.listRecords"
-    headers = {"Authorization": "Bearer " + session["accessJwt"]}
-    params = {
-        "repo": session["did"],  # Your own repository
-        "collection": "app.bsky.graph.follow",
-        "limit": 100  # Fetch up to 100 follow records
-    }
+    uri = graph.record_uri("following", did)
+    if uri:
+        return uri
 
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        records = response.json().get("records", [])
-
-        for record in records:
-            if record.get("value", {}).get("subject") == did:
-                return record["uri"]  # Get follow record URI
-
-        return None  # No follow record found
+        index_record_uris(session, "following", "app.bsky.graph.follow")
+        return graph.record_uri("following", did)  # None if no follow record exists
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok("Error", "Failed to fetch follow records: " + str(e))
         return None
 
 def get_block_record_uri(session, did, handle):
-    url = BASE_URL + "com.atproto.repo.listRecords"
-    headers = {"Authorization": "Bearer " + session["accessJwt"]}
-    params = {
-        "repo": session["did"],  # Your own repo
-        "collection": "app.bsky.graph.block",
-        "limit": 100  # Fetch up to 100 block records
-    }
+    uri = graph.record_uri("blocked", did)
+    if uri:
+        return uri
 
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        records = response.json().get("records", [])
-
-        for record in records:
-            if record.get("value", {}).get("subject") == did:
-                if "uri" in record:
-                    return record["uri"].split("/")[-1]  # Extract rkey from URI
-                else:
-                    xbmcgui.Dialog().ok("Error", "Block record for @" + handle + " is missing 'uri'.")
-                    return None
-
-        xbmcgui.Dialog().ok("Error", "Block record for @" + handle + " not found.")
-        return None
+        index_record_uris(session, "blocked", "app.bsky.graph.block")
+        return graph.record_uri("blocked", did)  # None if no block record exists
     except requests.exceptions.RequestException as e:
-        xbmcgui.Dialog().ok("Error", "Failed to fetch block records: " + str(e))
+        xbmcgui.Dialog().ok("Error", "Failed to fetch block records for @" + handle + ": " + str(e))
         return None
 
 def unfollow_user(session, handle):
-    did = get_did_from_handle(session, handle)
+    # Find the follow record URI
+    did, follow_uri = resolve_relationship_record(session, handle, "following")
     if not did:
         return
-
-    # Fetch the follow record URI
-    follow_uri = get_follow_record_uri(session, did)
     if not follow_uri:
         xbmcgui.Dialog().ok("Error", "Follow record for @" + handle + " not found.")
         return
 
     url = BASE_URL + "com.atproto.repo.deleteRecord"
-    headers = {"Authorization": "Bearer " + session["accessJwt"]}
     data = {
         "repo": session["did"],
         "collection": "app.bsky.graph.follow",
@@ -653,14 +801,16 @@ def unfollow_user(session, handle):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = xrpc.post(session, url, json=data)
         response.raise_for_status()
+        graph.remove('following', did)
+        graph.save()
         xbmcgui.Dialog().ok("Success", "You have unfollowed @" + handle)
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok("Error", "Failed to unfollow @" + handle + ": " + str(e))
 
 
-def block_user(session, handle=None):
+def block_user(session, handle=None, did=None):
     if handle is None:  # If no handle is given, prompt user
         keyboard = xbmc.Keyboard("", "Enter the handle of the user to block")
         keyboard.doModal()
@@ -671,12 +821,12 @@ def block_user(session, handle=None):
         xbmcgui.Dialog().ok("Error", "No handle entered.")
         return
 
-    did = get_did_from_handle(session, handle)
+    if not did:
+        did = get_did_from_handle(session, handle)
     if not did:
         return  # Stop if DID lookup fails
 
     url = BASE_URL + "com.atproto.repo.createRecord"
-    headers = {"Authorization": "Bearer " + session["accessJwt"]}
     data = {
         "repo": session["did"],
         "collection": "app.bsky.graph.block",
@@ -688,8 +838,10 @@ def block_user(session, handle=None):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = xrpc.post(session, url, json=data)
         response.raise_for_status()
+        graph.add('blocked', did, handle, response.json().get("uri"))
+        graph.save()
         xbmcgui.Dialog().ok("Success", "You have blocked @" + handle)
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok("Error", "Failed to block @" + handle + ": " + str(e))
@@ -705,31 +857,159 @@ def unblock_user(session, handle=None):
         xbmcgui.Dialog().ok("Error", "No handle entered.")
         return
 
-    did = get_did_from_handle(session, handle)
+    # Find the block record URI
+    did, block_uri = resolve_relationship_record(session, handle, "blocked")
     if not did:
         return  # Stop if DID lookup fails
-
-    # Fetch the block record rkey
-    block_rkey = get_block_record_uri(session, did, handle)
-    if not block_rkey:
+    if not block_uri:
         xbmcgui.Dialog().ok("Error", "Could not find block record for @" + handle)
         return
 
     url = BASE_URL + "com.atproto.repo.deleteRecord"
-    headers = {"Authorization": "Bearer " + session["accessJwt"]}
     data = {
         "repo": session["did"],
         "collection": "app.bsky.graph.block",
-        "rkey": block_rkey  # Use correct rkey
+        "rkey": block_uri.split("/")[-1]  # Extract rkey from URI
     }
 
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = xrpc.post(session, url, json=data)
         response.raise_for_status()
+        graph.remove('blocked', did)
+        graph.save()
         xbmcgui.Dialog().ok("Success", "You have unblocked @" + handle)
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok("Error", "Failed to unblock @" + handle + ": " + str(e))
 
+# Apply follow / unfollow / block / unblock operations in chunks with applyWrites, returning (handle, ok, error) per operation
+def bulk_relationship_writes(session, ops):
+    url = BASE_URL + "com.atproto.repo.applyWrites"
+    collections = {"follow": "app.bsky.graph.follow", "unfollow": "app.bsky.graph.follow", "block": "app.bsky.graph.block", "unblock": "app.bsky.graph.block"}
+    results = []
+
+    for i in range(0, len(ops), APPLY_WRITES_BATCH):
+        chunk = ops[i:i + APPLY_WRITES_BATCH]
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        writes = []
+        for op in chunk:
+            collection = collections[op["action"]]
+            if op["action"] in ("follow", "block"):
+                writes.append({
+                    "$type": "com.atproto.repo.applyWrites#create",
+                    "collection": collection,
+                    "value": {"$type": collection, "subject": op["did"], "createdAt": now}
+                })
+            else:
+                writes.append({
+                    "$type": "com.atproto.repo.applyWrites#delete",
+                    "collection": collection,
+                    "rkey": op["uri"].split("/")[-1]  # Extract rkey from URI
+                })
+
+        try:
+            response = xrpc.post(session, url, json={"repo": session["did"], "writes": writes})
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            # applyWrites is all-or-nothing, so the whole chunk failed
+            results += [(op["handle"], False, str(e)) for op in chunk]
+            continue
+
+        write_results = response.json().get("results", [])
+        for index, op in enumerate(chunk):
+            uri = write_results[index].get("uri") if index < len(write_results) else None
+            if op["action"] == "follow":
+                graph.add("following", op["did"], op["handle"], uri)
+            elif op["action"] == "block":
+                graph.add("blocked", op["did"], op["handle"], uri)
+            elif op["action"] == "unfollow":
+                graph.remove("following", op["did"])
+            else:
+                graph.remove("blocked", op["did"])
+            results.append((op["handle"], True, None))
+
+    graph.save()
+    return results
+
+# Confirm, run and report a bulk operation, listing any (handle, reason) pairs that were skipped before it
+def run_bulk_operation(session, title, ops, skipped=None):
+    skipped_lines = ["@{} - Skipped: {}".format(handle, reason) for handle, reason in skipped or []]
+    if not ops:
+        if skipped_lines:
+            xbmcgui.Dialog().select(title + " - Nothing to do", skipped_lines)
+        else:
+            xbmcgui.Dialog().ok(title, "Nothing to do.")
+        return
+    if not xbmcgui.Dialog().yesno(title, "This will affect {} users. Continue?".format(len(ops))):
+        return
+
+    results = bulk_relationship_writes(session, ops)
+    failed = [r for r in results if not r[1]]
+    xbmc.executebuiltin("Notification(Cortana Chat, {} done / {} failed / {} skipped, 5000)".format(len(results) - len(failed), len(failed), len(skipped_lines)))
+    xbmcgui.Dialog().select(title, ["@{} - {}".format(handle, "OK" if ok else "Failed: " + error) for handle, ok, error in results] + skipped_lines)
+
+# Follow every follower we don't follow yet
+def follow_back_all(session):
+    sync_graph(session, 'followers', iter_followers)
+    sync_graph(session, 'following', iter_following)
+    ops = [{"action": "follow", "did": did, "handle": handle} for did, handle in graph.members('followers').items() if not graph.contains('following', did)]
+    run_bulk_operation(session, "Follow Back All Followers", ops)
+
+# Unfollow everyone who doesn't follow back
+def unfollow_non_followers(session):
+    sync_graph(session, 'followers', iter_followers)
+    sync_graph(session, 'following', iter_following)
+    targets = [(did, handle) for did, handle in graph.members('following').items() if not graph.contains('followers', did)]
+
+    # Follow URIs usually come with the getFollows sync; scan our records once for any that are missing
+    if any(not graph.record_uri('following', did) for did, _ in targets):
+        try:
+            index_record_uris(session, 'following', "app.bsky.graph.follow")
+        except requests.exceptions.RequestException as e:
+            xbmcgui.Dialog().ok("Error", "Failed to fetch follow records: " + str(e))
+            return
+
+    ops = [{"action": "unfollow", "did": did, "handle": handle, "uri": graph.record_uri('following', did)} for did, handle in targets if graph.record_uri('following', did)]
+    run_bulk_operation(session, "Unfollow Non-Followers", ops)
+
+# Follow or block a comma separated list of handles
+def bulk_from_handle_list(session, action):
+    keyboard = xbmc.Keyboard("", "Enter handles to {}, separated by commas".format(action))
+    keyboard.doModal()
+    if not keyboard.isConfirmed():
+        return
+    actors = [h.strip().lstrip("@") for h in keyboard.getText().split(",") if h.strip()]
+    if not actors:
+        xbmcgui.Dialog().ok("Error", "No handle entered.")
+        return
+
+    # Resolve DIDs and current relationships 25 at a time
+    url = BASE_URL + "app.bsky.actor.getProfiles"
+    viewer_key = "following" if action == "follow" else "blocking"
+    already = "already following" if action == "follow" else "already blocked"
+    ops = []
+    skipped = []
+    try:
+        for i in range(0, len(actors), handles.BATCH_SIZE):
+            chunk = actors[i:i + handles.BATCH_SIZE]
+            response = xrpc.get(session, url, params={"actors": chunk})
+            response.raise_for_status()
+            profiles = response.json().get("profiles", [])
+            handles.seed(profiles)
+            found = set()
+            for profile in profiles:
+                found.update([profile["did"], profile.get("handle", "").lower()])
+                if profile.get("viewer", {}).get(viewer_key):
+                    skipped.append((profile.get("handle", profile["did"]), already))
+                else:
+                    ops.append({"action": action, "did": profile["did"], "handle": profile.get("handle", profile["did"])})
+            # getProfiles leaves out actors it can't resolve, e.g. a mistyped handle
+            skipped += [(actor, "not found") for actor in chunk if actor not in found and actor.lower() not in found]
+    except requests.exceptions.RequestException as e:
+        xbmcgui.Dialog().ok("Error", "Failed to look up users: " + str(e))
+        return
+
+    run_bulk_operation(session, "Bulk " + action.capitalize(), ops, skipped)
+
 # Display menu
 def display_settings_menu(session):
     while True:
@@ -768,7 +1048,10 @@ def display_game_settings_menu(session):
 def display_home_feed(session):
     cursor = None
     while True:
-        feed, next_cursor = fetch_home_feed(session, cursor)
+        # Served from the page cache unless a post was made or the page went stale
+        feed, next_cursor = get_home_feed_page(session, cursor)
+        if next_cursor:
+            prefetch_home_feed(session, next_cursor)
         items = ["Post", "Post Media", "Set Beacon", "Search for Beacon"]
         items += [post['post']['author'].get('handle', 'Unknown') + ': ' + post['post']['record'].get('text', 'No content') 
                   for post in feed if 'post' in post and 'author' in post['post'] and 'record' in post['post']]
@@ -811,11 +1094,10 @@ def display_home_feed(session):
 
 def display_user_feed(session, handle):
     url = BASE_URL + "app.bsky.feed.getAuthorFeed"
-    headers = {"Authorization": "Bearer " + session["accessJwt"]}
     params = {"actor": handle, "limit": 10}
 
     try:
-        response = requests.get(url, headers=headers, params=params)
+        response = xrpc.get(session, url, params=params)
         response.raise_for_status()
         data = response.json()
         posts = data.get("feed", [])
@@ -833,61 +1115,115 @@ def display_user_feed(session, handle):
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok("Error", "Failed to fetch feed: " + str(e))
 
-# Fetch post content by URI
-def fetch_post_content(session, uri):
+# Fetch post texts for many URIs, 25 per getPosts call, reusing texts fetched on earlier visits
+def fetch_post_texts(session, uris):
     url = BASE_URL + "app.bsky.feed.getPosts"
-    headers = {"Authorization": "Bearer " + session["accessJwt"]}
-    params = {"uris": uri}
+    texts = {}
+    with _post_texts_lock:
+        for uri in set(uris):
+            if uri in _post_texts:
+                texts[uri] = _post_texts.pop(uri)
+                _post_texts[uri] = texts[uri]
+    missing = [uri for uri in set(uris) if uri not in texts]
+
+    for i in range(0, len(missing), POSTS_BATCH):
+        chunk = missing[i:i + POSTS_BATCH]
+        try:
+            response = xrpc.get(session, url, params={"uris": chunk}, priority=xrpc.PRIORITY_LOW)
+            response.raise_for_status()
+            fetched = dict((post.get("uri"), post.get("record", {}).get("text", "No content")) for post in response.json().get("posts", []))
+        except requests.exceptions.RequestException:
+            texts.update((uri, "Failed to load content") for uri in chunk)
+            continue
 
-    try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        posts = response.json().get("posts", [])
-        if posts:
-            return posts[0].get("record", {}).get("text", "No content")
-    except requests.exceptions.RequestException:
-        return "Failed to load content"
+        with _post_texts_lock:
+            for uri in chunk:
+                texts[uri] = _post_texts[uri] = fetched.get(uri, "No content")
+            while len(_post_texts) > POST_TEXT_CACHE_SIZE:
+                _post_texts.popitem(last=False)
 
-    return "No content"
+    return texts
 
-# Display notifications with post content
-def display_notifications(session):
-    notifications = fetch_notifications(session)
+# Show a paged list; the first page shows right away and the next one is fetched in the background for "Load More"
+def select_from_pages(heading, pages, label, error_message):
     items = []
+    state = {'page': None, 'done': False, 'error': None}
 
-    for n in notifications:
-        author = n.get("author", {}).get("handle", "Unknown")
-        reason = n.get("reason", "Unknown")
-        text = n.get("record", {}).get("text", "")
+    def fetch_next_page():
+        try:
+            state['page'] = next(pages)
+        except StopIteration:
+            state['done'] = True
+        except requests.exceptions.RequestException as e:
+            state['error'] = e
+            state['done'] = True
 
-        # Fetch referenced post content if it's a like or repost
-        if reason in ["like", "repost"]:
-            post_uri = n.get("reasonSubject", "")
-            text = fetch_post_content(session, post_uri) if post_uri else "No content"
+    fetch_next_page()
+    while True:
+        if state['error'] is not None:
+            xbmcgui.Dialog().ok('Cortana Chat', error_message + str(state['error']))
+            state['error'] = None
+        if state['page'] is not None:
+            items.extend(state['page'])
+            state['page'] = None
+
+        prefetch = None
+        if not state['done']:
+            prefetch = threading.Thread(target=fetch_next_page)
+            prefetch.daemon = True
+            prefetch.start()
+
+        labels = [label(item) for item in items]
+        if prefetch:
+            labels.append("Load More...")
+        choice = xbmcgui.Dialog().select(heading, labels)
+
+        # Only "Load More..." needs the next page; otherwise leave the prefetch to finish on its own
+        if prefetch and choice == len(labels) - 1:
+            prefetch.join()
+            continue
+        if choice < 0 or choice >= len(items):
+            return None
+        return items[choice]
+
+# Stream notifications as display lines, page by page
+def iter_notification_lines(session):
+    for page in iter_notifications(session):
+        # Fetch the referenced posts of every like and repost on the page in one go
+        post_texts = fetch_post_texts(session, [n["reasonSubject"] for n in page if n.get("reason") in ["like", "repost"] and n.get("reasonSubject")])
+
+        lines = []
+        for n in page:
+            author = n.get("author", {}).get("handle", "Unknown")
+            reason = n.get("reason", "Unknown")
+            text = n.get("record", {}).get("text", "")
+
+            if reason in ["like", "repost"]:
+                post_uri = n.get("reasonSubject", "")
+                text = post_texts[post_uri] if post_uri else "No content"
+
+            lines.append("{} - {} - {}".format(reason, author, text))
+        yield lines
 
-        items.append("{} - {} - {}".format(reason, author, text))
+# Display notifications with post content
+def display_notifications(session):
+    select_from_pages("Notifications", iter_notification_lines(session), lambda line: line, 'Failed to fetch notifications: ')
 
-    xbmcgui.Dialog().select("Notifications", items)
+# Label a profile view as "Display Name (handle)"
+def profile_label(profile):
+    return profile.get("displayName", "No Name") + " (" + profile.get("handle", "Unknown") + ")"
 
 # Display followers
 def display_followers(session):
-    followers = fetch_followers(session)
-    items = [f.get("displayName", "No Name") + " (" + f.get("handle", "Unknown") + ")" for f in followers]
-
-    choice = xbmcgui.Dialog().select("Followers", items)
-    if choice >= 0:
-        handle = followers[choice].get("handle")
-        show_user_options(session, handle)
+    follower = select_from_pages("Followers", iter_followers(session), profile_label, 'Failed to fetch followers: ')
+    if follower:
+        show_user_options(session, follower.get("handle"))
 
 # Display following
 def display_following(session):
-    following = fetch_following(session)
-    items = [f.get("displayName", "No Name") + " (" + f.get("handle", "Unknown") + ")" for f in following]
-
-    choice = xbmcgui.Dialog().select("Following", items)
-    if choice >= 0:
-        handle = following[choice].get("handle")
-        show_user_options(session, handle)
+    followed = select_from_pages("Following", iter_following(session), profile_label, 'Failed to fetch following: ')
+    if followed:
+        show_user_options(session, followed.get("handle"))
 
 def display_mutuals(session):
     mutuals = fetch_mutuals(session)
@@ -899,13 +1235,9 @@ def display_mutuals(session):
         show_user_options(session, handle)
 
 def display_blocked(session):
-    blocked_users = fetch_blocked_users(session)
-    items = [b.get("handle", "Unknown") for b in blocked_users]
-
-    choice = xbmcgui.Dialog().select("Blocked Users", items)
-    if choice >= 0:
-        handle = blocked_users[choice].get("handle")
-        show_user_options(session, handle)
+    blocked_user = select_from_pages("Blocked Users", iter_blocked_users(session), lambda b: b.get("handle", "Unknown"), 'Failed to fetch blocked users: ')
+    if blocked_user:
+        show_user_options(session, blocked_user.get("handle"))
 
 def show_user_options(session, handle):
     options = ["View Feed", "Follow / Unfollow User", "Invite to Game", "Send Message", "Block / Unblock User"]
@@ -922,21 +1254,47 @@ def show_user_options(session, handle):
     elif choice == 4:
         toggle_block(session, handle)  # Now supports unblocking
 
+# Bring one set of the local graph in line with fresh viewer state, which also sees removals made on other devices
+def apply_viewer_state(name, relationship, handle):
+    if relationship[name]:
+        graph.add(name, relationship["did"], handle, relationship[name])
+    else:
+        graph.remove(name, relationship["did"])
+    graph.save()
+
+# Check whether we follow or block a user, trusting the viewer state of one getProfile call over the local set,
+# since incremental syncs can't see an unfollow or unblock made elsewhere. Returns (did, is_member).
+def current_relationship(session, handle, name, iter_pages):
+    relationship = get_relationship(session, handle)
+    if not relationship or not relationship["did"]:
+        return None, False
+    if relationship["viewer"]:
+        apply_viewer_state(name, relationship, handle)
+        return relationship["did"], bool(relationship[name])
+
+    # No viewer state in the response, so fall back to the local set
+    sync_graph(session, name, iter_pages)
+    return relationship["did"], graph.contains(name, relationship["did"])
+
 def toggle_follow(session, handle):
-    following_users = set(f.get("handle") for f in fetch_following(session))
+    did, following = current_relationship(session, handle, 'following', iter_following)
+    if not did:
+        return
 
-    if handle in following_users:
+    if following:
         unfollow_user(session, handle)  # Now correctly calls unfollow
     else:
-        follow_user(session, handle)  # Calls follow function
+        follow_user(session, handle, did)  # Calls follow function
 
 def toggle_block(session, handle):
-    blocked_users = set(f.get("handle") for f in fetch_blocked_users(session))
+    did, blocked = current_relationship(session, handle, 'blocked', iter_blocked_users)
+    if not did:
+        return
 
-    if handle in blocked_users:
+    if blocked:
         unblock_user(session, handle)  # Call the existing function
     else:
-        block_user(session, handle)  # Call the existing function
+        block_user(session, handle, did)  # Call the existing function
 
 def invite_user_to_game(session, handle):
     games = load_games()
@@ -958,61 +1316,197 @@ def invite_user_to_game(session, handle):
         }
 
         url = BASE_URL + "com.atproto.repo.createRecord"
-        headers = {"Authorization": "Bearer " + session["accessJwt"]}
         data = {"repo": session["did"], "collection": "app.bsky.feed.post", "record": post}
 
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = xrpc.post(session, url, json=data)
             response.raise_for_status()
             xbmc.executebuiltin("Notification(Cortana Chat, Game invite sent to @" + handle + ", 2500)")
         except requests.exceptions.RequestException as e:
             xbmc.executebuiltin("Notification(Cortana Chat, Failed to send game invite: " + str(e) + ", 2500)")
 
+# Label a conversation as "handle: last message"
+def conversation_label(convo):
+    return convo.get('user_handle', 'Unknown') + ': ' + convo.get('lastMessage', {}).get('text', 'No message')
+
+# Show a list right away while refresh() fetches a newer copy in the background; if it differs, the dialog is re-shown with it
+def select_while_refreshing(heading, items, label, refresh):
+    state = {'fresh': None, 'showing': False}
+    lock = threading.Lock()
+
+    def run_refresh():
+        try:
+            fresh = refresh()
+        except requests.exceptions.RequestException as e:
+            xbmc.log("Cortana Chat: Failed to refresh {}. Error: {}".format(heading, str(e)), xbmc.LOGERROR)
+            return
+        with lock:
+            if [label(item) for item in fresh] == [label(item) for item in items]:
+                return
+            state['fresh'] = fresh
+            # Close the stale list so the loop below re-shows it with the fresh data
+            if state['showing'] and xbmc.getCondVisibility('Window.IsActive(selectdialog)'):
+                xbmc.executebuiltin('Dialog.Close(selectdialog)')
+
+    refresher = threading.Thread(target=run_refresh)
+    refresher.daemon = True
+    refresher.start()
+
+    dialog = xbmcgui.Dialog()
+    while True:
+        with lock:
+            if state['fresh'] is not None:
+                items = state['fresh']
+                state['fresh'] = None
+            state['showing'] = True
+        choice = dialog.select(heading, [label(item) for item in items])
+        with lock:
+            state['showing'] = False
+            if choice == -1 and state['fresh'] is not None:
+                continue  # Closed by the refresh, not the user
+        return choice, items
+
+# Run Chat screens from an explicit stack; a screen's show function returns a view to open, True to show itself again or None to go back
+def run_views(session, view):
+    stack = [view]
+    while stack:
+        view = stack[-1]
+        result = view['show'](session, view)
+        if result is None:
+            stack.pop()
+        elif result is not True:
+            stack.append(result)
+
+# Check whether a view's data is old enough to refresh
+def is_stale(view):
+    return view['loaded_at'] is None or time.time() - view['loaded_at'] >= VIEW_MAX_AGE
+
+# Wrap a fetch so its result is also kept on the view, even if it arrives after the dialog closed
+def refresh_view(view, fetch):
+    def refresh():
+        data = fetch()
+        view['latest'] = (time.time(), data)
+        return data
+    return refresh
+
+# Adopt data from a background refresh
+def adopt_refresh(view):
+    latest = view.pop('latest', None)
+    if latest:
+        view['loaded_at'], view['data'] = latest
+
+# Conversations screen state
+def conversations_view():
+    return {'show': show_conversations, 'data': None, 'loaded_at': None}
+
+# Show the conversations list; a saved list shows right away while a fresh one loads in the background
+def show_conversations(session, view):
+    adopt_refresh(view)
+    if view['data'] is None:
+        view['data'] = load_cached_conversations(session)
+        if view['data'] is None:
+            view['data'] = fetch_conversations(session)
+            view['loaded_at'] = time.time()
+
+    if is_stale(view):
+        choice, conversations = select_while_refreshing('Conversations', view['data'], conversation_label, refresh_view(view, lambda: request_conversations(session)))
+    else:
+        conversations = view['data']
+        choice = xbmcgui.Dialog().select('Conversations', [conversation_label(c) for c in conversations])
+    adopt_refresh(view)
+
+    if choice < 0:
+        return None
+    return messages_view(conversations[choice].get('id'))
+
 # Display conversations
 def display_conversations(session):
-    conversations = fetch_conversations(session)
-    items = [c.get('user_handle', 'Unknown') + ': ' + c.get('lastMessage', {}).get('text', 'No message') for c in conversations]
-    dialog = xbmcgui.Dialog()
-    choice = dialog.select('Conversations', items)
-    if choice >= 0:
-        convo_id = conversations[choice].get('id')
-        display_messages(session, convo_id)
+    run_views(session, conversations_view())
+
+# Label a stored message as "handle: text"
+def message_label(message):
+    sender = message.get('sender', {})
+    handle = sender.get('handle')
+    if not handle or handle == 'Unknown':  # Stored messages only keep the DID, older files may hold the placeholder
+        handle = handles.get(sender.get('did')) or 'Unknown'
+    return handle + ': ' + message.get('text', '')
+
+# Messages screen state for a conversation
+def messages_view(convo_id):
+    return {'show': show_messages, 'convo_id': convo_id, 'data': None, 'loaded_at': None}
+
+# Build the Messages list; action and "Load Older..." entries ride along so a refresh can relabel it
+def message_items(data, convo_id):
+    items = [{'action': action} for action in ['Reply', 'Nudge', 'Invite To Game']]
+    items += [dict(entry['message'], sender=entry['sender'], pending=True) for entry in outbox.pending(convo_id)]
+    items += data['messages']
+    if data['cursor']:
+        items.append({'action': 'Load Older...', 'cursor': data['cursor']})
+    return items
+
+# Label an entry of the Messages list
+def message_item_label(item):
+    if 'action' in item:
+        return item['action']
+    if item.get('pending'):
+        return message_label(item) + ' (Sending...)'
+    return message_label(item)
+
+# Show the messages of a conversation; stored history shows right away while newer messages sync in the background
+def show_messages(session, view):
+    convo_id = view['convo_id']
+    adopt_refresh(view)
+    if view['data'] is None:
+        view['data'] = history.load(convo_id)
+        if not view['data']['messages']:
+            try:
+                view['data'] = sync_messages(session, convo_id)
+                view['loaded_at'] = time.time()
+            except requests.exceptions.RequestException as e:
+                xbmcgui.Dialog().ok('Cortana Chat', 'Failed to fetch messages: ' + str(e))
+
+    items = message_items(view['data'], convo_id)
+    if is_stale(view) or outbox.delivered_at(convo_id) > view['loaded_at']:
+        refresh = refresh_view(view, lambda: sync_messages(session, convo_id))
+        choice, items = select_while_refreshing('Messages', items, message_item_label, lambda: message_items(refresh(), convo_id))
+    else:
+        choice = xbmcgui.Dialog().select('Messages', [message_item_label(item) for item in items])
+    adopt_refresh(view)
 
-# Display messages in a conversation
-def display_messages(session, convo_id):
-    messages = fetch_messages(session, convo_id)
-    items = ['Reply', 'Nudge', 'Invite To Game'] + [m.get('sender', {}).get('handle', 'Unknown') + ': ' + m.get('text', '') for m in messages]
-    dialog = xbmcgui.Dialog()
-    choice = dialog.select('Messages', items)
-    
-    if choice == -1:
-        display_conversations(session)  # User backed out
-    elif choice == 0:
-        reply_to_conversation(session, convo_id)
-    elif choice == 1:
-        send_nudge(session, convo_id)
-    elif choice == 2:
-        invite_to_game(session, convo_id)
-    elif choice > 2:
-        message_text = messages[choice - 3].get('text', '')
-        match = re.match(r"(.*) would like to play '(.*)'", message_text)
+    if choice < 0:
+        return None  # User backed out
+    action = items[choice].get('action')
+    if action == 'Load Older...':
+        try:
+            view['data'] = load_older_messages(session, convo_id, items[choice]['cursor'])
+        except requests.exceptions.RequestException as e:
+            xbmcgui.Dialog().ok('Cortana Chat', 'Failed to fetch older messages: ' + str(e))
+    elif action:
+        if action == 'Reply':
+            reply_to_conversation(session, convo_id)
+        elif action == 'Nudge':
+            send_nudge(session, convo_id)
+        else:
+            invite_to_game(session, convo_id)
+    else:
+        match = re.match(r"(.*) would like to play '(.*)'", items[choice].get('text', ''))
         if match:
-            game_title = match.group(2)
-            display_message_options(session, convo_id, game_title)
+            return message_options_view(view, match.group(2))
+    return True
 
-# Display message options
-def display_message_options(session, convo_id, game_title):
-    dialog = xbmcgui.Dialog()
+# Message Options screen state for a game invite
+def message_options_view(messages, game_title):
+    return {'show': show_message_options, 'messages': messages, 'game_title': game_title}
+
+# Show the options for a game invite, then go back to the messages
+def show_message_options(session, view):
     options = ['Reply', 'Accept Invite', 'Decline Invite']
-    choice = dialog.select('Message Options', options)
-    if choice == -1:
-        display_messages(session, convo_id)
-    elif choice == 0:
-        reply_to_conversation(session, convo_id)
+    choice = xbmcgui.Dialog().select('Message Options', options)
+    if choice == 0:
+        reply_to_conversation(session, view['messages']['convo_id'])
     elif choice == 1:
-        launch_game(game_title)
-    elif choice == 2:
-        display_messages(session, convo_id)
+        launch_game(view['game_title'])
+    return None
 
 
 # Display game invite options in home feed
@@ -1029,6 +1523,12 @@ def display_game_invite_options(game_title):
     elif invite_choice == 1:  # Decline Invite
         return
 
+# Queue a chat message for the outbox worker; it shows in the conversation right away
+def queue_message(session, convo_id, text):
+    now = datetime.datetime.utcnow().isoformat() + 'Z'
+    message = {'$type': 'chat.bsky.convo.message', 'text': text, 'createdAt': now}
+    return outbox.add(convo_id, message, {'did': session['did'], 'handle': session['handle']})
+
 # Send a message
 def send_message(session, handle):
     keyboard = xbmc.Keyboard('', 'Enter your message')
@@ -1046,83 +1546,45 @@ def send_message(session, handle):
             xbmcgui.Dialog().ok("Error", "Failed to find or start conversation with @" + handle)
             return
 
-        now = datetime.datetime.utcnow().isoformat() + 'Z'
-        message = {'$type': 'chat.bsky.convo.message', 'text': message_text, 'createdAt': now}
-        url = CHAT_URL + 'chat.bsky.convo.sendMessage'
-        headers = {'Authorization': 'Bearer ' + session['accessJwt']}
-        data = {'convoId': convo_id, 'message': message}
-
-        try:
-            response = requests.post(url, headers=headers, json=data)
-            response.raise_for_status()
-            xbmc.executebuiltin("Notification(Success, Message sent to @" + handle + ", 2500)")
-        except requests.exceptions.RequestException as e:
-            xbmc.executebuiltin("Notification(Error, Failed to send message: " + str(e) + ", 2500)")
+        queue_message(session, convo_id, message_text)
+        xbmc.executebuiltin("Notification(Cortana Chat, Sending message to @" + handle + ", 2500)")
 
-# Check if a conversation already exists, otherwise makes a new one.
+# Find the conversation with a user from the index, otherwise get (or start) it with one getConvoForMembers call
 def get_or_create_conversation(session, handle):
-    # Fetch existing conversations
-    conversations = fetch_conversations(session)
-
-    # Look for an existing conversation with this handle
-    for convo in conversations:
-        if convo.get('user_handle') == handle:
-            return convo.get('id')
+    index = load_convo_index(session)
+    did = graph.did_for_handle('following', handle) or graph.did_for_handle('followers', handle) or handles.did_for(handle)
+    convo_id = (index.get(did) if did else None) or index.get(handle)
+    if convo_id:
+        return convo_id
 
-    # If no conversation exists, start a new one
-    did = get_did_from_handle(session, handle)
+    # Only users missing from the local graph and the handle cache need a lookup for their DID first
     if not did:
-        return None
-
-    url = CHAT_URL + 'chat.bsky.convo.createConversation'
-    headers = {'Authorization': 'Bearer ' + session['accessJwt']}
-    data = {'participants': [did]}
+        did = get_did_from_handle(session, handle)
+        if not did:
+            return None
 
+    url = CHAT_URL + 'chat.bsky.convo.getConvoForMembers'
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = xrpc.get(session, url, params={'members': [did]})
         response.raise_for_status()
-        return response.json().get('convoId')
+        convo = response.json().get('convo', {})
+        handles.seed(convo.get('members', []))
+        index_conversations(session, [convo])
+        return convo.get('id')
     except requests.exceptions.RequestException as e:
         xbmcgui.Dialog().ok("Error", "Failed to start conversation with @" + handle + ": " + str(e))
         return None
 
-
-
-# Reply to a conversation and return to message list
+# Reply to a conversation
 def reply_to_conversation(session, convo_id):
     keyboard = xbmc.Keyboard('', 'Enter your reply')
     keyboard.doModal()
     if keyboard.isConfirmed():
-        reply_text = keyboard.getText()
-        now = datetime.datetime.utcnow().isoformat() + 'Z'
-        message = {'$type': 'chat.bsky.convo.message', 'text': reply_text, 'createdAt': now}
-        url = CHAT_URL + 'chat.bsky.convo.sendMessage'
-        headers = {'Authorization': 'Bearer ' + session['accessJwt']}
-        data = {'convoId': convo_id, 'message': message}
-        try:
-            response = requests.post(url, headers=headers, json=data)
-            response.raise_for_status()
-            xbmc.executebuiltin("Notification(Cortana Chat, Reply sent successfully!, 2500)")
-        except requests.exceptions.RequestException as e:
-            xbmc.executebuiltin("Notification(Cortana Chat, Failed to send reply: " + str(e) + ", 2500)")
-    display_messages(session, convo_id)
+        queue_message(session, convo_id, keyboard.getText())
 
 # Nudge function
 def send_nudge(session, convo_id):
-    nudge_text = session['handle'] + " has sent you a nudge!"
-    now = datetime.datetime.utcnow().isoformat() + 'Z'
-    message = {'$type': 'chat.bsky.convo.message', 'text': nudge_text, 'createdAt': now}
-    url = CHAT_URL + 'chat.bsky.convo.sendMessage'
-    headers = {'Authorization': 'Bearer ' + session['accessJwt']}
-    data = {'convoId': convo_id, 'message': message}
-    
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        xbmc.executebuiltin("Notification(Cortana Chat, Nudge sent successfully!, 2500)")
-    except requests.exceptions.RequestException as e:
-        xbmc.executebuiltin("Notification(Cortana Chat, Failed to send nudge: " + str(e) + ", 2500)")
-    display_messages(session, convo_id)
+    queue_message(session, convo_id, session['handle'] + " has sent you a nudge!")
 
 # Invite to a game
 def invite_to_game(session, convo_id):
@@ -1136,22 +1598,7 @@ def invite_to_game(session, convo_id):
     selected_game = dialog.select('Select a game to invite', sorted_games)
     if selected_game >= 0:
         game_title = sorted_games[selected_game]
-        reply_text = session['handle'] + " would like to play '" + game_title + "'"
-        now = datetime.datetime.utcnow().isoformat() + 'Z'
-        message = {'$type': 'chat.bsky.convo.message', 'text': reply_text, 'createdAt': now}
-        url = CHAT_URL + 'chat.bsky.convo.sendMessage'
-        headers = {'Authorization': 'Bearer ' + session['accessJwt']}
-        data = {'convoId': convo_id, 'message': message}
-        try:
-            response = requests.post(url, headers=headers, json=data)
-            response.raise_for_status()
-
-            xbmc.executebuiltin("Notification(Cortana Chat, Invite sent successfully!, 2500)")
-            display_messages(session, convo_id)
-            return
-        except requests.exceptions.RequestException as e:
-            xbmc.executebuiltin("Notification(Cortana Chat, Failed to send invite: " + str(e) + ", 2500)")
-            display_messages(session, convo_id)
+        queue_message(session, convo_id, session['handle'] + " would like to play '" + game_title + "'")
 
 def load_games():
     games = {}
@@ -1366,6 +1813,8 @@ def main():
     session = authenticate(username, app_password)
     if not session:
         return
+    graph.set_owner(session['did'])
+    outbox.start(session, CHAT_URL)
 
     # Check for arguments passed from XBMC
     if len(sys.argv) > 1:
@@ -1383,5 +1832,9 @@ def main():
     else:
         display_menu(session)
 
+    # Give queued messages a chance to go out; anything left is sent on the next run
+    outbox.drain(OUTBOX_EXIT_WAIT)
+    xrpc.close()
+
 if __name__ == '__main__':
     main()
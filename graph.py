@@ -0,0 +1,147 @@
+# Cortana Chat v2.0 by faithvoid - https://github.com/faithvoid/script.cortanachatv2
+# Local follower / following / blocked store for the current profile, kept in graph.json
+
+import time
+import threading
+import xbmc
+import store
+
+GRAPH_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/graph.json'.format(xbmc.getInfoLabel('System.ProfileName')))
+SETS = ('followers', 'following', 'blocked')
+VIEWER_KEYS = {'following': 'following', 'blocked': 'blocking'}  # Profile viewer field holding our record URI for a set
+FRESH_AGE = 300  # Seconds a set is trusted without asking the server
+FULL_SYNC_AGE = 3600  # Seconds between full resyncs, which also catch removals made elsewhere
+
+_graph = {}
+_by_handle = {}  # Set name -> handle -> DID
+_lock = threading.RLock()
+
+# Load graph.json once and build the handle index
+def load():
+    with _lock:
+        if _graph:
+            return
+        saved = store.load_json(GRAPH_FILE, {})
+        for name in SETS:
+            _graph[name] = saved.get(name, {})
+            _by_handle[name] = dict((handle, did) for did, handle in _graph[name].items())
+        _graph['synced'] = saved.get('synced', {})
+        _graph['full_synced'] = saved.get('full_synced', {})
+        _graph['owner'] = saved.get('owner')
+        _graph['uris'] = saved.get('uris', {'following': {}, 'blocked': {}})
+
+# Start over if graph.json belongs to another account logged in on this profile
+def set_owner(did):
+    with _lock:
+        load()
+        if _graph['owner'] != did:
+            for name in SETS:
+                _graph[name] = {}
+                _by_handle[name] = {}
+            _graph['synced'] = {}
+            _graph['full_synced'] = {}
+            _graph['uris'] = {'following': {}, 'blocked': {}}
+            _graph['owner'] = did
+
+# Write the graph back to graph.json
+def save():
+    with _lock:
+        load()
+        store.save_json(GRAPH_FILE, _graph)
+
+# Check whether a set was refreshed recently enough to use as-is
+def is_fresh(name):
+    load()
+    return time.time() - _graph['synced'].get(name, 0) < FRESH_AGE
+
+# Check whether a set is due a full resync rather than an incremental one
+def needs_full_sync(name):
+    load()
+    return time.time() - _graph['full_synced'].get(name, 0) >= FULL_SYNC_AGE
+
+# Add a DID to a set, optionally with the URI of our follow or block record
+def add(name, did, handle, uri=None):
+    with _lock:
+        load()
+        old_handle = _graph[name].get(did)
+        if old_handle and _by_handle[name].get(old_handle) == did:
+            del _by_handle[name][old_handle]
+        _graph[name][did] = handle
+        _by_handle[name][handle] = did
+        if uri:
+            set_record_uri(name, did, uri)
+
+# Remove a DID from a set
+def remove(name, did):
+    with _lock:
+        load()
+        handle = _graph[name].pop(did, None)
+        if handle and _by_handle[name].get(handle) == did:
+            del _by_handle[name][handle]
+        _graph['uris'].get(name, {}).pop(did, None)
+
+# Merge a page of profile views into a set, returning how many DIDs were new
+def merge_page(name, page):
+    new = 0
+    with _lock:
+        load()
+        for profile in page:
+            did = profile.get('did')
+            if not did:
+                continue
+            if did not in _graph[name]:
+                new += 1
+            uri = profile.get('viewer', {}).get(VIEWER_KEYS[name]) if name in VIEWER_KEYS else None
+            add(name, did, profile.get('handle', 'Unknown'), uri)
+    return new
+
+# Replace a whole set after a full resync
+def replace(name, page):
+    with _lock:
+        load()
+        _graph[name] = {}
+        _by_handle[name] = {}
+        merge_page(name, page)
+
+# Record when a set was last synced
+def mark_synced(name, full=False):
+    with _lock:
+        load()
+        now = time.time()
+        _graph['synced'][name] = now
+        if full:
+            _graph['full_synced'][name] = now
+
+# Remember the URI of our follow or block record for a DID
+def set_record_uri(name, did, uri):
+    with _lock:
+        load()
+        _graph['uris'][name][did] = uri
+
+# Look up the cached URI of our follow or block record for a DID
+def record_uri(name, did):
+    load()
+    return _graph['uris'][name].get(did)
+
+# Copy of a set as DID -> handle
+def members(name):
+    with _lock:
+        load()
+        return dict(_graph[name])
+
+# Check if a DID is in a set
+def contains(name, did):
+    load()
+    return did in _graph[name]
+
+# Look up the DID of a handle in a set
+def did_for_handle(name, handle):
+    load()
+    return _by_handle[name].get(handle)
+
+# Handles of everyone who follows us and is followed back, sorted
+def mutuals():
+    with _lock:
+        load()
+        following = _graph['following']
+        return sorted(handle for did, handle in _graph['followers'].items() if did in following)
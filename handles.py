@@ -0,0 +1,164 @@
+# Cortana Chat v2.0 by faithvoid - https://github.com/faithvoid/script.cortanachatv2
+# In-memory DID -> handle cache backed by handles.txt
+
+import os
+import threading
+import requests
+import xbmc
+import xrpc
+import store
+from collections import OrderedDict
+
+HANDLES_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/handles.txt'.format(xbmc.getInfoLabel('System.ProfileName')))
+MAX_ENTRIES = 1000  # Most recently used handles kept in memory, keeps the cache small on the Xbox
+BATCH_SIZE = 25  # Max actors per app.bsky.actor.getProfiles call
+COMPACT_AFTER = 200  # Rewrite handles.txt once it holds this many duplicate or evicted lines
+
+_cache = OrderedDict()
+_state = {'loaded': False, 'stale_lines': 0, 'deferred': False}
+_pending = []  # Lines waiting for flush() while writes are deferred
+_inflight = {}  # DID -> threading.Event set once the batch resolving it finishes
+_lock = threading.RLock()
+
+# Drop the least recently used handles beyond MAX_ENTRIES, their lines in handles.txt go stale
+def _evict():
+    while len(_cache) > MAX_ENTRIES:
+        _cache.popitem(last=False)
+        _state['stale_lines'] += 1
+
+# Mark a DID as most recently used
+def _touch(did, handle):
+    _cache.pop(did, None)
+    _cache[did] = handle
+
+# Read handles.txt into memory once; later lines win over earlier ones
+def load():
+    with _lock:
+        if _state['loaded']:
+            return
+        _state['loaded'] = True
+        if not os.path.exists(HANDLES_FILE):
+            return
+        lines = 0
+        with open(HANDLES_FILE, 'r') as f:
+            for line in f:
+                parts = line.strip().split(',')
+                if len(parts) < 2 or not parts[0]:
+                    continue
+                lines += 1
+                _touch(parts[0], parts[1])
+                _evict()
+        _state['stale_lines'] = lines - len(_cache)
+        if _state['stale_lines'] >= COMPACT_AFTER:
+            compact()
+
+# Look up a handle by DID, returning None on a miss
+def get(did):
+    with _lock:
+        load()
+        handle = _cache.get(did)
+        if handle is not None:
+            _touch(did, handle)
+        return handle
+
+# Look up a DID by handle among the cached handles, returning None on a miss
+def did_for(handle):
+    with _lock:
+        load()
+        for did, cached in reversed(list(_cache.items())):
+            if cached == handle:
+                _touch(did, handle)
+                return did
+        return None
+
+# Remember several resolved handles with a single append to handles.txt
+def put_many(pairs):
+    with _lock:
+        load()
+        lines = []
+        for did, handle in pairs:
+            if not did or not handle or handle == 'Unknown':
+                continue
+            if _cache.get(did) == handle:
+                _touch(did, handle)
+                continue
+            if did in _cache:
+                _state['stale_lines'] += 1
+            _touch(did, handle)
+            _evict()
+            lines.append('{},{}\n'.format(did, handle))
+        if not lines:
+            return
+        _pending.extend(lines)
+        if not _state['deferred']:
+            flush()
+
+# Keep new handles in memory until flush() is called, for long-running callers like the notifier
+def defer_writes():
+    with _lock:
+        _state['deferred'] = True
+
+# Append any pending handles to handles.txt in one write
+def flush():
+    with _lock:
+        if _pending:
+            try:
+                with open(HANDLES_FILE, 'a') as f:
+                    f.write(''.join(_pending))
+                del _pending[:]
+            except (IOError, OSError) as e:
+                xbmc.log("Cortana Chat: Could not write handles.txt: {}".format(str(e)), xbmc.LOGERROR)
+        if _state['stale_lines'] >= COMPACT_AFTER:
+            compact()
+
+# Seed the cache from profile views already embedded in an API response
+def seed(views):
+    put_many([(view.get('did'), view.get('handle')) for view in views])
+
+# Rewrite handles.txt with one line per cached DID
+def compact():
+    with _lock:
+        def write(f):
+            for did, handle in _cache.items():
+                f.write('{},{}\n'.format(did, handle))
+        if store.replace_file(HANDLES_FILE, write):
+            _state['stale_lines'] = 0
+            del _pending[:]  # Already part of the rewritten file
+
+# Resolve handles for many DIDs, batching misses into getProfiles calls and sharing lookups already in flight
+def resolve(session, base_url, dids):
+    result = {}
+    wanted = []
+    waiting = []
+    with _lock:
+        for did in set(dids):
+            handle = get(did)
+            if handle:
+                result[did] = handle
+            elif did in _inflight:
+                waiting.append(_inflight[did])
+            else:
+                _inflight[did] = threading.Event()
+                wanted.append(did)
+
+    try:
+        for i in range(0, len(wanted), BATCH_SIZE):
+            try:
+                response = xrpc.get(session, base_url + 'app.bsky.actor.getProfiles', params={'actors': wanted[i:i + BATCH_SIZE]}, priority=xrpc.PRIORITY_LOW)
+                response.raise_for_status()
+                seed(response.json().get('profiles', []))
+            except requests.exceptions.RequestException as e:
+                xbmc.log("Cortana Chat: Failed to fetch profiles. Error: {}".format(str(e)), xbmc.LOGERROR)
+    finally:
+        with _lock:
+            for did in wanted:
+                _inflight.pop(did).set()
+
+    # Wait for lookups another caller started
+    for event in waiting:
+        event.wait(xrpc.TIMEOUT)
+
+    for did in set(dids):
+        if did not in result:
+            result[did] = get(did) or 'Unknown'
+    return result
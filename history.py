@@ -0,0 +1,174 @@
+# Cortana Chat v2.0 by faithvoid - https://github.com/faithvoid/script.cortanachatv2
+# Per-conversation message history kept on disk under history/: messages are appended to a .jsonl file, one JSON line each,
+# and a small .json file beside it holds the newest message ID and the cursor for the page before the oldest one
+
+import os
+import json
+import threading
+import xbmc
+import store
+
+HISTORY_DIR = xbmc.translatePath('special://home/userdata/profiles/{}/history'.format(xbmc.getInfoLabel('System.ProfileName')))
+MAX_MESSAGES = 500  # Messages kept per conversation when its file is compacted
+COMPACT_AFTER = 2 * MAX_MESSAGES  # Lines a conversation file may grow to before it is compacted
+
+_lock = threading.RLock()
+
+# Path of the message file for a conversation
+def _lines_path(convo_id):
+    return os.path.join(HISTORY_DIR, convo_id.replace('/', '_') + '.jsonl')
+
+# Path of the head/cursor file for a conversation
+def _meta_path(convo_id):
+    return os.path.join(HISTORY_DIR, convo_id.replace('/', '_') + '.json')
+
+# Keep only the message fields the Messages screen needs; the sender's handle is looked up when rendering.
+# The oldest message of each fetched page also keeps the cursor for the page before it, so the file can be cut there
+def _trim(message, before=None):
+    sender = message.get('sender', {})
+    trimmed = {
+        'id': message.get('id'),
+        'text': message.get('text', ''),
+        'sentAt': message.get('sentAt'),
+        'sender': {'did': sender.get('did')},
+    }
+    if before:
+        trimmed['before'] = before
+    return trimmed
+
+# Trim a page of messages (newest first), marking its oldest message with the cursor for the page before it
+def _trim_page(messages, before):
+    page = [_trim(m) for m in messages]
+    if page and before:
+        page[-1]['before'] = before
+    return page
+
+# Create the history folder if needed
+def _ensure_dir():
+    if not os.path.isdir(HISTORY_DIR):
+        try:
+            os.makedirs(HISTORY_DIR)
+        except OSError as e:
+            xbmc.log("Cortana Chat: Could not create {}: {}".format(HISTORY_DIR, str(e)), xbmc.LOGERROR)
+            return False
+    return True
+
+# Load the head/cursor file, converting a history saved by an older version as a single JSON file
+def _load_meta(convo_id):
+    saved = store.load_json(_meta_path(convo_id), {})
+    if 'messages' in saved:
+        return _rewrite(convo_id, [_trim(m) for m in saved['messages']], saved.get('cursor'), saved.get('complete', False))
+    return {
+        'head': saved.get('head'),
+        'cursor': saved.get('cursor'),
+        'complete': saved.get('complete', False),
+        'lines': saved.get('lines', 0),
+    }
+
+# Read every stored message, newest first; duplicates and a line cut short by a crash are skipped
+def _read_messages(convo_id):
+    by_id = {}
+    try:
+        with open(_lines_path(convo_id), 'r') as f:
+            for line in f:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if message.get('id'):
+                    by_id[message['id']] = message
+    except (IOError, OSError):
+        pass
+    return sorted(by_id.values(), key=lambda m: m['id'], reverse=True)  # Message IDs are TIDs, so they sort by time
+
+# Append messages to the end of a conversation's file
+def _append(convo_id, meta, messages):
+    if not messages or not _ensure_dir():
+        return False
+    try:
+        with open(_lines_path(convo_id), 'a') as f:
+            for message in messages:
+                f.write(json.dumps(message, separators=(',', ':')) + '\n')
+    except (IOError, OSError) as e:
+        xbmc.log("Cortana Chat: Could not write {}: {}".format(_lines_path(convo_id), str(e)), xbmc.LOGERROR)
+        return False
+    meta['lines'] += len(messages)
+    return True
+
+# Replace a conversation's files with the given messages (newest first)
+def _rewrite(convo_id, messages, cursor, complete):
+    meta = {
+        'head': messages[0]['id'] if messages else None,
+        'cursor': cursor,
+        'complete': complete,
+        'lines': len(messages),
+    }
+    if _ensure_dir():
+        def write(f):
+            for message in messages:
+                f.write(json.dumps(message, separators=(',', ':')) + '\n')
+        store.replace_file(_lines_path(convo_id), write)
+        store.save_json(_meta_path(convo_id), meta)
+    return meta
+
+# Rewrite a conversation's file with only its newest messages, cut at a page boundary so the cursor still
+# fetches the first dropped message
+def _compact(convo_id, meta):
+    messages = _read_messages(convo_id)
+    cuts = [index for index, message in enumerate(messages) if message.get('before')]
+    kept = [index for index in cuts if index < MAX_MESSAGES] or cuts[:1]
+    if not kept or kept[-1] == len(messages) - 1:
+        # No page boundary to cut at, or the boundary is already the tail; just drop duplicate lines
+        return _rewrite(convo_id, messages, meta['cursor'], meta['complete'])
+    tail = kept[-1]
+    return _rewrite(convo_id, messages[:tail + 1], messages[tail]['before'], False)
+
+# Load the stored history of a conversation; messages are newest first, cursor points at the next older page
+def load(convo_id):
+    with _lock:
+        meta = _load_meta(convo_id)
+        return {
+            'messages': _read_messages(convo_id),
+            'cursor': meta['cursor'],
+            'complete': meta['complete'],
+        }
+
+# ID of the newest stored message, or None for an empty history
+def head_id(convo_id):
+    with _lock:
+        return _load_meta(convo_id)['head']
+
+# Append messages newer than the stored head (newest first, as getMessages returns them), compacting the file once it is long.
+# cursors maps the ID of the oldest message of each full page to the cursor for the page before it
+def add_newer(convo_id, messages, cursors=None):
+    cursors = cursors or {}
+    with _lock:
+        meta = _load_meta(convo_id)
+        newer = [_trim(m, cursors.get(m.get('id'))) for m in messages if m.get('id') and (not meta['head'] or m['id'] > meta['head'])]
+        if not _append(convo_id, meta, newer):
+            return False
+        meta['head'] = newer[0]['id']
+        if meta['lines'] > COMPACT_AFTER:
+            _compact(convo_id, meta)
+        else:
+            store.save_json(_meta_path(convo_id), meta)
+        return True
+
+# Append the page fetched with expected_cursor and remember the cursor for the page before it;
+# skipped if a sync started the history over meanwhile
+def add_older(convo_id, messages, cursor, expected_cursor):
+    with _lock:
+        meta = _load_meta(convo_id)
+        if meta['cursor'] != expected_cursor:
+            return False
+        _append(convo_id, meta, _trim_page(messages, cursor))
+        meta['cursor'] = cursor
+        meta['complete'] = not cursor
+        store.save_json(_meta_path(convo_id), meta)
+        return True
+
+# Start the history over from a newest page, used when the stored messages no longer join up with it
+def reset(convo_id, messages, cursor):
+    with _lock:
+        _rewrite(convo_id, _trim_page(messages, cursor), cursor, not cursor)
+        return True
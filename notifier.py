@@ -1,23 +1,46 @@
 import xbmc
-import xbmcgui
 import requests
+import xrpc
+import handles
+import store
 import os
+import random
+import sys
+import threading
 import time
 import unicodedata
+from collections import deque
 
 # Script constants
 SCRIPT_NAME = 'Cortana Chat'
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))  # Get the script's directory
 BASE_URL = 'https://bsky.social/xrpc/'
 CHAT_URL = 'https://api.bsky.chat/xrpc/'
-CHECK_INTERVAL = 1  # Interval in seconds to check for new messages and notifications - Currently set to 1 due to timing hack below to stop the script from crashing when launching games (see end of main function to adjust real check_interval frequency).
+SYNC_MODE = 'log'  # 'log' follows chat.bsky.convo.getLog from a saved cursor, 'full' refetches every conversation each cycle
+FETCH_CONCURRENCY = 8  # Max conversations fetched at once in 'full' mode, keep at or below xrpc.POOL_SIZE
+MAX_LOG_PAGES = 5  # Max getLog pages applied per cycle, the rest are picked up next cycle
+CHECK_INTERVAL = 1  # Scheduler tick in seconds - kept short so the notifier exits quickly when the PID file is removed (e.g. before launching a game)
+PID_CHECK_INTERVAL = 1  # Seconds between PID file checks
+CHAT_INTERVAL_MIN = 5  # Seconds between chat syncs while messages are arriving
+CHAT_INTERVAL_MAX = 60  # Chat syncs back off to this interval while the inbox is idle
+NOTIFICATION_INTERVAL_MIN = 15  # Seconds between notification syncs while notifications are arriving
+NOTIFICATION_INTERVAL_MAX = 120  # Notification syncs back off to this interval while idle
+HANDLES_FLUSH_INTERVAL = 60  # Seconds between writes of newly resolved handles to handles.txt
+RECENT_MESSAGE_IDS = 200  # Size of the ring buffer of recently seen message IDs kept next to the per-conversation marks
+BACKOFF_FACTOR = 2  # How much an idle task's interval grows after each quiet run
+ERROR_BACKOFF_MAX = 600  # Longest wait in seconds before retrying a task that keeps failing
+AUTH_RETRY_DELAY = 600  # Seconds to wait after an auth failure the session refresh couldn't fix
+BREAKER_THRESHOLD = 3  # Consecutive network/server failures before a task only runs its cheap probe
+OUTAGE_ERRORS = ('network', 'server', 'rate_limited')  # Error kinds that count towards opening the circuit breaker
 LOGIN_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/login.txt'.format(xbmc.getInfoLabel('System.ProfileName')))
-MESSAGES_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/messages.txt'.format(xbmc.getInfoLabel('System.ProfileName')))
-HANDLES_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/handles.txt'.format(xbmc.getInfoLabel('System.ProfileName')))
+SEEN_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/seen_messages.json'.format(xbmc.getInfoLabel('System.ProfileName')))
+LEGACY_MESSAGES_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/messages.txt'.format(xbmc.getInfoLabel('System.ProfileName')))
 PID_FILE = os.path.join(SCRIPT_DIR, "notifier.pid")
-NOTIFICATIONS_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/notifications.txt'.format(xbmc.getInfoLabel('System.ProfileName')))
+CHAT_CURSOR_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/chat_cursor.txt'.format(xbmc.getInfoLabel('System.ProfileName')))
+LEGACY_NOTIFICATIONS_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/notifications.txt'.format(xbmc.getInfoLabel('System.ProfileName')))
 NUDGE_FILE = os.path.join(SCRIPT_DIR, "nudge.mp3")  # Construct full path to nudge.mp3
 LAST_NUDGE_TIME = 0
+DEGRADED = {'tasks': set(), 'notified': False}  # Tasks with an open circuit breaker, and whether the user was told
 
 # Create PID file
 def create_pid_file():
@@ -45,147 +68,396 @@ def load_credentials():
                 return lines[0].strip(), lines[1].strip()
     return None, None
 
-# Authenticate with BlueSky using app password
+# Authenticate with BlueSky, reusing the session saved by either script and falling back to the app password
 def authenticate(username, app_password):
-    url = BASE_URL + 'com.atproto.server.createSession'
-    data = {
-        'identifier': username,
-        'password': app_password
-    }
     try:
-        response = requests.post(url, json=data)
-        response.raise_for_status()
+        session = xrpc.resume_session(BASE_URL, username, app_password)
         xbmc.log("{}: Authentication successful".format(SCRIPT_NAME), xbmc.LOGINFO)
-        return response.json()
+        return session
     except requests.exceptions.RequestException as e:
         xbmc.log("{}: Authentication failed. Error: {}".format(SCRIPT_NAME, str(e)), xbmc.LOGERROR)
         return None
 
+# Fetch the number of unread notifications, a cheap probe before the full list
+def fetch_unread_count(session):
+    url = BASE_URL + 'app.bsky.notification.getUnreadCount'
+    response = xrpc.get(session, url)
+    response.raise_for_status()
+    return response.json().get('count', 0)
+
 # Fetch notifications from BlueSky
-def fetch_notifications(session):
+def fetch_notifications(session, limit=None):
     url = BASE_URL + 'app.bsky.notification.listNotifications'
-    headers = {
-        'Authorization': 'Bearer ' + session['accessJwt']
-    }
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()  # Raise an error for bad status codes
-        return response.json().get('notifications', [])
-    except requests.exceptions.RequestException as e:
-        xbmcgui.Dialog().ok(SCRIPT_NAME, 'Failed to fetch notifications. Error: {}'.format(str(e)))
-        return []
+    params = {}
+    if limit:
+        params['limit'] = limit
+    response = xrpc.get(session, url, params=params)
+    response.raise_for_status()  # Raise an error for bad status codes
+    return response.json().get('notifications', [])
 
 # Fetch conversations from BlueSky
-def fetch_conversations(session):
+def fetch_conversations(session, limit=None):
     url = CHAT_URL + 'chat.bsky.convo.listConvos'
-    headers = {
-        'Authorization': 'Bearer ' + session['accessJwt']
-    }
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        convos = response.json().get('convos', [])
-        return convos
-    except requests.exceptions.RequestException as e:
-        xbmc.log("{}: Failed to fetch conversations. Error: {}".format(SCRIPT_NAME, str(e)), xbmc.LOGERROR)
-        return []
+    params = {}
+    if limit:
+        params['limit'] = limit
+    response = xrpc.get(session, url, params=params)
+    response.raise_for_status()
+    convos = response.json().get('convos', [])
+
+    # Members already carry their handles, so message senders rarely need a lookup
+    handles.seed([member for convo in convos for member in convo.get('members', [])])
+    return convos
 
 # Fetch messages for a conversation from BlueSky
 def fetch_messages(session, convo_id):
     url = CHAT_URL + 'chat.bsky.convo.getMessages'
-    headers = {
-        'Authorization': 'Bearer ' + session['accessJwt']
-    }
     params = {
         'convoId': convo_id
     }
+    response = xrpc.get(session, url, params=params)
+    response.raise_for_status()
+    messages = response.json().get('messages', [])
+    for message in messages:
+        message['convoId'] = convo_id
+    return prepare_messages(session, messages)
+
+# Fetch messages for several conversations on a small worker pool, returning the results in the same order; a failed fetch is returned as its exception
+def fetch_messages_parallel(session, convo_ids):
+    results = [[] for _ in convo_ids]
+    pending = deque(enumerate(convo_ids))
+
+    def worker():
+        while True:
+            try:
+                index, convo_id = pending.popleft()
+            except IndexError:
+                return
+            try:
+                results[index] = fetch_messages(session, convo_id)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                xbmc.log("{}: Failed to fetch messages. Error: {}".format(SCRIPT_NAME, str(e)), xbmc.LOGERROR)
+                results[index] = e
+
+    threads = [threading.Thread(target=worker) for _ in range(min(FETCH_CONCURRENCY, len(convo_ids)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+# Resolve sender handles and sanitize the text of fetched messages
+def prepare_messages(session, messages):
+    # Collect all DIDs to resolve from the resident handle cache in bulk
+    dids = {message['sender']['did'] for message in messages if 'sender' in message and 'did' in message['sender']}
+    profiles = handles.resolve(session, BASE_URL, dids) if dids else {}
+
+    # Ensure each message has the sender's handle
+    for message in messages:
+        if 'sender' in message and 'did' in message['sender']:
+            message['sender']['handle'] = profiles.get(message['sender']['did'], 'Unknown')
+
+    # Sanitize message text
+    for message in messages:
+        if 'text' in message:
+            message['text'] = sanitize_text(message['text'])
+
+    return messages
+
+# Load the saved getLog cursor
+def load_chat_cursor():
+    if os.path.exists(CHAT_CURSOR_FILE):
+        with open(CHAT_CURSOR_FILE, 'r') as f:
+            return f.read().strip() or None
+    return None
+
+# Save the getLog cursor so a restart resumes from it
+def save_chat_cursor(cursor):
+    with open(CHAT_CURSOR_FILE, 'w') as f:
+        f.write(cursor)
+
+# Start the log from the newest conversation rev, so only events after launch are applied
+def bootstrap_chat_cursor(session):
+    revs = [convo.get('rev', '') for convo in fetch_conversations(session)]
+    return max(revs) if revs else None
+
+# Apply new chat.bsky.convo.getLog events since the cursor, returning the new messages and cursor
+def sync_chat_log(session, cursor):
+    url = CHAT_URL + 'chat.bsky.convo.getLog'
+    messages = []
+    start_cursor = cursor
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        messages = response.json().get('messages', [])
-        
-        # Collect all DIDs to fetch profiles in bulk
-        dids = {message['sender']['did'] for message in messages if 'sender' in message and 'did' in message['sender']}
-        profiles = load_profiles()
-        new_profiles = {did: fetch_profile(session, did) for did in dids if did not in profiles}
-        profiles.update(new_profiles)
-        save_profiles(new_profiles)
-        
-        # Ensure each message has the sender's handle
-        for message in messages:
-            if 'sender' in message and 'did' in message['sender']:
-                sender_profile = profiles.get(message['sender']['did'], {})
-                message['sender']['handle'] = sender_profile.get('handle', 'Unknown')
-
-        # Sanitize message text
-        for message in messages:
-            if 'text' in message:
-                message['text'] = sanitize_text(message['text'])
-
-        return messages
+        for _ in range(MAX_LOG_PAGES):
+            response = xrpc.get(session, url, params={'cursor': cursor})
+            response.raise_for_status()
+            data = response.json()
+            logs = data.get('logs', [])
+            for log in logs:
+                if log.get('$type') != 'chat.bsky.convo.defs#logCreateMessage':
+                    continue
+                message = log.get('message', {})
+                if message.get('$type') == 'chat.bsky.convo.defs#messageView':
+                    message['convoId'] = log.get('convoId')
+                    messages.append(message)
+            new_cursor = data.get('cursor')
+            if not logs or not new_cursor or new_cursor == cursor:
+                break
+            cursor = new_cursor
+            save_chat_cursor(cursor)
     except requests.exceptions.RequestException as e:
-        xbmc.log("{}: Failed to fetch messages. Error: {}".format(SCRIPT_NAME, str(e)), xbmc.LOGERROR)
-        return []
-
-# Fetch profile information from BlueSky
-def fetch_profile(session, did):
-    url = BASE_URL + 'app.bsky.actor.getProfile'
-    headers = {
-        'Authorization': 'Bearer ' + session['accessJwt']
-    }
-    params = {
-        'actor': did
+        if cursor == start_cursor:
+            raise  # Nothing applied, let the scheduler back off
+        xbmc.log("{}: Failed to fetch chat log. Error: {}".format(SCRIPT_NAME, str(e)), xbmc.LOGERROR)
+    return prepare_messages(session, messages), cursor
+
+# Load the seen-message store: the newest message ID and rev per conversation plus a small ring of recent IDs
+def load_seen_store():
+    data = store.load_json(SEEN_FILE)
+    return {
+        'marks': (data or {}).get('marks', {}),
+        'revs': (data or {}).get('revs', {}),
+        'recent': deque((data or {}).get('recent', []), RECENT_MESSAGE_IDS),
+        'new': data is None,
+        'dirty': False
     }
+
+# Check if a message is at or below its conversation's mark, or was seen recently
+def is_seen(seen, message):
+    message_id = message.get('id', '')
+    mark = seen['marks'].get(message.get('convoId'))
+    return (mark is not None and message_id <= mark) or message_id in seen['recent']
+
+# Record a message as seen; message IDs are TIDs, so they sort by time
+def mark_seen(seen, message):
+    message_id = message.get('id', '')
+    convo_id = message.get('convoId')
+    if convo_id and message_id > seen['marks'].get(convo_id, ''):
+        seen['marks'][convo_id] = message_id
+    seen['recent'].append(message_id)
+    seen['dirty'] = True
+
+# Write the seen-message store once per cycle if anything changed
+def save_seen_store(seen):
+    if seen['dirty']:
+        store.save_json(SEEN_FILE, {'marks': seen['marks'], 'revs': seen['revs'], 'recent': list(seen['recent'])})
+        seen['dirty'] = False
+
+# Record the rev a conversation was synced up to
+def mark_rev(seen, convo_id, rev):
+    if rev:
+        seen['revs'][convo_id] = rev
+        seen['dirty'] = True
+
+# Split conversations into new messages already carried in lastMessage and (convo ID, rev) pairs that need getMessages;
+# the revs of the latter are only recorded once their fetch succeeds
+def changed_conversations(convos, seen, user_did):
+    inline = []
+    to_fetch = []
+    for convo in convos:
+        convo_id = convo.get('id')
+        rev = convo.get('rev', '')
+        if not convo_id or (rev and rev <= seen['revs'].get(convo_id, '')):
+            continue  # Nothing happened in this conversation since the last sync
+        last_message = convo.get('lastMessage', {})
+        if (convo.get('unreadCount', 0) <= 1 and last_message.get('$type') == 'chat.bsky.convo.defs#messageView'
+                and last_message.get('sender', {}).get('did') != user_did):
+            last_message['convoId'] = convo_id
+            inline.append(last_message)
+            mark_rev(seen, convo_id, rev)
+        else:
+            to_fetch.append((convo_id, rev))
+    return inline, to_fetch
+
+# Remove the message ID list kept by older versions, the seen-message store replaces it
+def remove_legacy_message_ids():
+    if os.path.exists(LEGACY_MESSAGES_FILE):
+        os.remove(LEGACY_MESSAGES_FILE)
+
+# Mark notifications up to seen_at as seen on the server
+def update_seen(session, seen_at):
+    url = BASE_URL + 'app.bsky.notification.updateSeen'
     try:
-        response = requests.get(url, headers=headers, params=params)
+        response = xrpc.post(session, url, json={'seenAt': seen_at})
         response.raise_for_status()
-        return response.json()
+        return True
     except requests.exceptions.RequestException as e:
-        xbmc.log("{}: Failed to fetch profile. Error: {}".format(SCRIPT_NAME, str(e)), xbmc.LOGERROR)
-        return {}
-
-# Load profiles from file
-def load_profiles():
-    if os.path.exists(HANDLES_FILE):
-        with open(HANDLES_FILE, 'r') as f:
-            return {line.split(",")[0]: {"handle": line.split(",")[1].strip()} for line in f}
-    return {}
-
-# Save profiles to file
-def save_profiles(profiles):
-    with open(HANDLES_FILE, 'a') as f:
-        for did, profile in profiles.items():
-            f.write("{},{}\n".format(did, profile.get('handle', 'Unknown')))
-
-# Load old message IDs from file
-def load_old_message_ids():
-    if os.path.exists(MESSAGES_FILE):
-        with open(MESSAGES_FILE, 'r') as f:
-            return set(line.strip() for line in f)
-    return set()
-
-# Save new message ID to file
-def save_message_id(message_id):
-    with open(MESSAGES_FILE, 'a') as f:
-        f.write(message_id + '\n')
-
-# Load old notification IDs from file
-def load_old_notification_ids():
-    if os.path.exists(NOTIFICATIONS_FILE):
-        with open(NOTIFICATIONS_FILE, 'r') as f:
-            return set(line.strip() for line in f)
-    return set()
-
-# Save new notification ID to file
-def save_notification_id(notification_id):
-    if notification_id is not None:
-        with open(NOTIFICATIONS_FILE, 'a') as f:
-            f.write(str(notification_id) + '\n')
+        xbmc.log("{}: Failed to update seen notifications. Error: {}".format(SCRIPT_NAME, str(e)), xbmc.LOGERROR)
+        return False
+
+# Remove the notification ID list kept by older versions, the seenAt watermark replaces it
+def remove_legacy_notification_ids():
+    if os.path.exists(LEGACY_NOTIFICATIONS_FILE):
+        os.remove(LEGACY_NOTIFICATIONS_FILE)
 
 # Sanitize text by removing non-ASCII characters
 def sanitize_text(text):
     return ''.join(char for char in text if ord(char) < 128)
 
+# Show a toast for each new message from someone else, playing the nudge sound when needed
+def notify_messages(messages, seen, user_did, silent=False):
+    global LAST_NUDGE_TIME
+    count = 0
+    for message in sorted(messages, key=lambda m: m.get('id', '')):
+        if not message.get('id') or is_seen(seen, message):
+            continue
+        mark_seen(seen, message)
+
+        # Skip messages sent by the logged-in user, and everything on a silent first run
+        if silent or message.get('sender', {}).get('did') == user_did:
+            continue
+
+        user_handle = message.get('sender', {}).get('handle', 'Unknown')
+        text = message.get('text', 'No text').strip().lower()
+
+        # Check for nudge message
+        nudge_message = "{} has sent you a nudge!".format(user_handle).lower()
+        current_time = time.time()
+
+        if text == nudge_message:
+            if current_time - LAST_NUDGE_TIME >= 30:  # 30-second cooldown
+                xbmc.executebuiltin('PlayMedia("{}")'.format(NUDGE_FILE))
+                LAST_NUDGE_TIME = current_time  # Update last nudge time
+
+        xbmc.executebuiltin('Notification("{}", "{}", 5000, "")'.format(user_handle, sanitize_text(text)))
+        count += 1
+    return count
+
+# Show a toast for each unread notification newer than the seenAt watermark
+def notify_notifications(session, watermark):
+    unread = fetch_unread_count(session)
+    if unread <= 0:
+        return 0
+
+    count = 0
+    newest = watermark.get('seen_at')
+    notifications = fetch_notifications(session, min(unread, 50))
+    for notification in notifications:
+        indexed_at = notification.get('indexedAt', '')
+        if not notification.get('isRead') and indexed_at > (watermark.get('seen_at') or ''):
+            if indexed_at > (newest or ''):
+                newest = indexed_at
+            reason = notification.get('reason', 'No Title')
+            author = notification.get('author', {})
+            user_handle = author.get('handle', 'Unknown user')
+            message = notification.get('record', {}).get('text', '')
+
+            notification_text = "{}: {}".format(reason.capitalize(), user_handle, message)
+            xbmc.executebuiltin('Notification("Cortana Chat", "{}", 5000, "N/A")'.format(sanitize_text(notification_text)))
+            count += 1
+
+    # Move the watermark forward locally even if updateSeen fails, so nothing is shown twice
+    if newest and newest != watermark.get('seen_at'):
+        watermark['seen_at'] = newest
+        update_seen(session, newest)
+    return count
+
+# Create a scheduled task that runs every min_interval seconds while active, backing off towards max_interval while idle
+def make_task(name, func, min_interval, max_interval=None, probe=None):
+    return {
+        'name': name,
+        'func': func,
+        'probe': probe,  # Cheap request run instead of func while the circuit breaker is open
+        'min': min_interval,
+        'max': max_interval or min_interval,
+        'interval': min_interval,
+        'next_run': 0,
+        'failures': 0,
+        'open': False
+    }
+
+# Classify a failed request: 'network', 'rate_limited', 'server', 'auth' or 'client'
+def classify_error(error):
+    if isinstance(error, xrpc.RateLimited):
+        return 'rate_limited'
+    if isinstance(error, ValueError):
+        return 'server'  # An HTML error page or a truncated body instead of JSON
+    response = getattr(error, 'response', None)
+    if response is None:
+        return 'network'
+    if response.status_code == 429:
+        return 'rate_limited'
+    if response.status_code >= 500:
+        return 'server'
+    if response.status_code in (401, 403) or xrpc.is_auth_error(response):
+        return 'auth'
+    return 'client'
+
+# Seconds the server asked us to wait before retrying, or 0
+def retry_after(error):
+    if isinstance(error, xrpc.RateLimited):
+        return error.retry_after
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('Retry-After'):
+            return float(headers['Retry-After'])
+        if headers.get('ratelimit-reset'):
+            return max(0, xrpc.reset_delay(headers['ratelimit-reset']))
+    except ValueError:
+        pass
+    return 0
+
+# How long to wait before retrying a failed task, with jitter so retries don't line up
+def error_delay(task, kind, error):
+    if kind == 'auth':
+        delay = AUTH_RETRY_DELAY
+    elif kind == 'client':
+        delay = task['max']  # Retrying sooner would fail the same way
+    else:
+        delay = min(ERROR_BACKOFF_MAX, task['min'] * BACKOFF_FACTOR ** task['failures'])
+        if kind == 'rate_limited':
+            delay = max(delay, retry_after(error))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+# Record a failed run, backing off and opening the circuit breaker on repeated outages
+def record_failure(task, error):
+    kind = classify_error(error)
+    task['failures'] += 1
+    delay = error_delay(task, kind, error)
+    task['next_run'] = time.time() + delay
+    xbmc.log("{}: {} sync failed ({}), retrying in {:.0f}s. Error: {}".format(SCRIPT_NAME, task['name'], kind, delay, str(error)), xbmc.LOGERROR)
+
+    if kind in OUTAGE_ERRORS and task['failures'] >= BREAKER_THRESHOLD and task['probe'] and not task['open']:
+        task['open'] = True
+        DEGRADED['tasks'].add(task['name'])
+        # One toast per outage, however many tasks are affected
+        if not DEGRADED['notified']:
+            DEGRADED['notified'] = True
+            xbmc.executebuiltin('Notification("{}", "Connection problems, retrying in the background", 5000, "")'.format(SCRIPT_NAME))
+
+# Close the circuit breaker once the probe gets through
+def close_breaker(task):
+    task['open'] = False
+    DEGRADED['tasks'].discard(task['name'])
+    xbmc.log("{}: {} sync recovered".format(SCRIPT_NAME, task['name']), xbmc.LOGINFO)
+    if not DEGRADED['tasks']:
+        DEGRADED['notified'] = False
+
+# Run every task that is due; a task returning True had activity and drops back to its fastest interval
+def run_due_tasks(tasks):
+    for task in tasks:
+        now = time.time()
+        if now < task['next_run']:
+            continue
+        try:
+            if task['open']:
+                task['probe']()
+                close_breaker(task)
+            active = task['func']()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            record_failure(task, e)
+            continue
+        except (IOError, OSError) as e:
+            # Local file trouble (cursor, seen store, handles.txt); keep running and try again next interval
+            xbmc.log("{}: {} sync could not write its state. Error: {}".format(SCRIPT_NAME, task['name'], str(e)), xbmc.LOGERROR)
+            task['next_run'] = now + task['interval']
+            continue
+        task['failures'] = 0
+        if active:
+            task['interval'] = task['min']
+        else:
+            task['interval'] = min(task['max'], task['interval'] * BACKOFF_FACTOR)
+        task['next_run'] = now + task['interval']
+
 # Check sys.argv for "stop" argument
 def check_stop():
     if len(sys.argv) > 1 and sys.argv[1].lower() == "stop":
@@ -210,64 +482,90 @@ def main():
     if not session:
         return
 
-    old_message_ids = load_old_message_ids()
-    old_notification_ids = load_old_notification_ids()
+    # Keep handles resident for the life of the notifier and write new ones in batches
+    handles.defer_writes()
+    handles.load()
+
+    # A brand new store only records what is already there in full mode, so the first scan doesn't replay every conversation
+    seen = load_seen_store()
+    silent = {'value': seen['new'] and SYNC_MODE == 'full'}
+    remove_legacy_message_ids()
+    remove_legacy_notification_ids()
+    watermark = {'seen_at': None}
     user_did = session.get('did')
 
-    while True:
-        # Check if the PID file exists, exit if it's removed
+    state = {'running': True, 'chat_cursor': None}
+    if SYNC_MODE == 'log':
+        state['chat_cursor'] = load_chat_cursor()
+
+    # Check if the PID file exists, stop if it's removed
+    def check_running():
         if not check_pid_file():
             xbmc.log("{}: Notifier PID file removed, exiting...".format(SCRIPT_NAME), xbmc.LOGINFO)
-            break  # Exit the loop if the PID file is deleted
-
-        # Fetch conversations and messages from BlueSky
-        convos = fetch_conversations(session)
-        for convo in convos:
-            messages = fetch_messages(session, convo.get('id'))
-            for message in messages:
-                message_id = message.get('id')
-                if message_id not in old_message_ids:
-                    # Skip messages sent by the logged-in user
-                    if message.get('sender', {}).get('did') == user_did:
-                        continue
-
-                    old_message_ids.add(message_id)
-                    save_message_id(message_id)
-                    user_handle = message.get('sender', {}).get('handle', 'Unknown')
-                    text = message.get('text', 'No text').strip().lower()
-
-                    # Check for nudge message
-                    nudge_message = "{} has sent you a nudge!".format(user_handle).lower()
-                    current_time = time.time()
-
-                    if text == nudge_message:
-                        if current_time - LAST_NUDGE_TIME >= 30:  # 30-second cooldown
-                            xbmc.executebuiltin('PlayMedia("{}")'.format(NUDGE_FILE))
-                            LAST_NUDGE_TIME = current_time  # Update last nudge time
-
-                    xbmc.executebuiltin('Notification("{}", "{}", 5000, "")'.format(user_handle, sanitize_text(text)))
-
-            # Fetch notifications
-            notifications = fetch_notifications(session)
-            for notification in notifications:
-                notification_id = notification.get('cid')
-                if notification_id not in old_notification_ids:
-                    old_notification_ids.add(notification_id)
-                    save_notification_id(notification_id)
-                    reason = notification.get('reason', 'No Title')
-                    author = notification.get('author', {})
-                    user_handle = author.get('handle', 'Unknown user')
-                    message = notification.get('record', {}).get('text', '')
-
-                    notification_text = "{}: {}".format(reason.capitalize(), user_handle, message)
-                    xbmc.executebuiltin('Notification("Cortana Chat", "{}", 5000, "N/A")'.format(sanitize_text(notification_text)))
-
-            # Sleep for the specified interval before checking again
+            state['running'] = False
+        return False
+
+    # Fetch new messages and show them
+    def sync_chat():
+        error = None
+        if SYNC_MODE == 'log':
+            if not state['chat_cursor']:
+                state['chat_cursor'] = bootstrap_chat_cursor(session)
+                if state['chat_cursor']:
+                    save_chat_cursor(state['chat_cursor'])
+                return False
+
+            # Only apply chat events newer than the saved cursor
+            messages, state['chat_cursor'] = sync_chat_log(session, state['chat_cursor'])
+            count = notify_messages(messages, seen, user_did)
+        else:
+            # Fetch conversations and messages from BlueSky
+            count = 0
+            convos = fetch_conversations(session)
+
+            # Only conversations whose rev moved need a look, and a single new message is already in lastMessage
+            inline, to_fetch = changed_conversations(convos, seen, user_did)
+            count += notify_messages(prepare_messages(session, inline), seen, user_did, silent['value'])
+            results = fetch_messages_parallel(session, [convo_id for convo_id, rev in to_fetch])
+            for (convo_id, rev), messages in zip(to_fetch, results):
+                if isinstance(messages, Exception):
+                    error = error or messages  # Rev left alone so the next sync fetches it again
+                    continue
+                count += notify_messages(messages, seen, user_did, silent['value'])
+                mark_rev(seen, convo_id, rev)
+            if convos and not error:
+                silent['value'] = False
+
+        save_seen_store(seen)
+        if error:
+            raise error
+        return count > 0
+
+    # Fetch notifications and show them
+    def sync_notifications():
+        return notify_notifications(session, watermark) > 0
+
+    # Write newly resolved handles to handles.txt
+    def flush_handles():
+        handles.flush()
+        return False
+
+    tasks = [
+        make_task('pid', check_running, PID_CHECK_INTERVAL),
+        make_task('chat', sync_chat, CHAT_INTERVAL_MIN, CHAT_INTERVAL_MAX, lambda: fetch_conversations(session, 1)),
+        make_task('notifications', sync_notifications, NOTIFICATION_INTERVAL_MIN, NOTIFICATION_INTERVAL_MAX, lambda: fetch_unread_count(session)),
+        make_task('handles', flush_handles, HANDLES_FLUSH_INTERVAL)
+    ]
+
+    while state['running']:
+        run_due_tasks(tasks)
+        if state['running']:
             xbmc.sleep(CHECK_INTERVAL * 1000)
 
-        xbmc.log("{}: Notifier stopped.".format(SCRIPT_NAME), xbmc.LOGINFO)
+    handles.flush()
+    xrpc.close()
+    xbmc.log("{}: Notifier stopped.".format(SCRIPT_NAME), xbmc.LOGINFO)
 
 # Run the main function
 if __name__ == '__main__':
     main()
-    time.sleep(5) # This is the real check_interval value, modify this if you want to increase/decrease notification frequency! Currently defaults to 5 seconds.
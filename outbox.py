@@ -0,0 +1,196 @@
+# Cortana Chat v2.0 by faithvoid - https://github.com/faithvoid/script.cortanachatv2
+# Persistent chat outbox kept in outbox.json; a background worker delivers queued messages in order per conversation
+
+import threading
+import time
+import requests
+import xbmc
+import xrpc
+import store
+
+OUTBOX_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/outbox.json'.format(xbmc.getInfoLabel('System.ProfileName')))
+BATCH_SIZE = 100  # Max items per chat.bsky.convo.sendMessageBatch call
+RETRY_MIN = 2  # Seconds before the first retry, doubled after each failure
+RETRY_MAX = 300  # Longest wait between retries
+
+_queue = []  # Queued messages, oldest first
+_delivered = {}  # Conversation ID -> time a message was last delivered to it
+_state = {'loaded': False, 'session': None, 'chat_url': None, 'worker': None}
+_lock = threading.RLock()
+_wake = threading.Event()
+
+# Read outbox.json into memory once
+def load():
+    with _lock:
+        if _state['loaded']:
+            return
+        _state['loaded'] = True
+        _queue.extend(store.load_json(OUTBOX_FILE, []))
+
+# Write the queue back to outbox.json
+def save():
+    with _lock:
+        store.save_json(OUTBOX_FILE, _queue)
+
+# Start delivering with the given session, picking up anything left over from the last run
+def start(session, chat_url):
+    with _lock:
+        load()
+        _state['session'] = session
+        _state['chat_url'] = chat_url
+        if _queue:
+            _ensure_worker()
+
+# Queue a message for a conversation and wake the worker
+def add(convo_id, message, sender):
+    with _lock:
+        load()
+        entry = {
+            'id': '{}-{}'.format(time.time(), len(_queue)),
+            'convoId': convo_id,
+            'message': message,
+            'sender': sender,
+            'attempts': 0,
+            'next_try': 0,
+        }
+        _queue.append(entry)
+        save()
+        _ensure_worker()
+        _wake.set()
+        return entry
+
+# Messages still waiting to be delivered to a conversation, newest first like getMessages
+def pending(convo_id):
+    with _lock:
+        load()
+        return [entry for entry in reversed(_queue) if entry['convoId'] == convo_id]
+
+# When a message was last delivered to a conversation, or 0
+def delivered_at(convo_id):
+    with _lock:
+        return _delivered.get(convo_id, 0)
+
+# Wait up to timeout seconds for the queue to empty, e.g. before the script exits
+def drain(timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with _lock:
+            if not _queue or _state['worker'] is None:
+                return not _queue
+        time.sleep(0.5)
+    return False
+
+# Start the worker thread unless it is already running
+def _ensure_worker():
+    if _state['worker'] is None and _state['session'] is not None:
+        worker = threading.Thread(target=_run)
+        worker.daemon = True
+        _state['worker'] = worker
+        worker.start()
+
+# The first messages of each conversation that are due, in queue order
+def _due_groups(now):
+    groups = []
+    by_convo = {}
+    for entry in _queue:
+        convo_id = entry['convoId']
+        if convo_id not in by_convo:
+            # Only the head of a conversation decides whether it is due, so messages stay in order
+            by_convo[convo_id] = [] if entry['next_try'] <= now else None
+            if by_convo[convo_id] is not None:
+                groups.append(by_convo[convo_id])
+        if by_convo[convo_id] is not None and len(by_convo[convo_id]) < BATCH_SIZE:
+            by_convo[convo_id].append(entry)
+    return groups
+
+# Send a group of messages for one conversation, batching when there is more than one
+def _send(group):
+    session = _state['session']
+    if len(group) == 1:
+        url = _state['chat_url'] + 'chat.bsky.convo.sendMessage'
+        data = {'convoId': group[0]['convoId'], 'message': group[0]['message']}
+    else:
+        url = _state['chat_url'] + 'chat.bsky.convo.sendMessageBatch'
+        data = {'items': [{'convoId': entry['convoId'], 'message': entry['message']} for entry in group]}
+    response = xrpc.post(session, url, json=data, priority=xrpc.PRIORITY_HIGH)
+    response.raise_for_status()
+
+# Check whether a failed send is worth retrying; other client errors would fail the same way again
+def _is_retryable(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return True
+    return response.status_code >= 500 or response.status_code in (408, 429)
+
+# Push a group back for a retry with a doubling delay, keeping it at the head of its conversation
+def _retry_later(group, error):
+    with _lock:
+        attempts = group[0]['attempts'] + 1
+        delay = min(RETRY_MAX, RETRY_MIN * 2 ** (attempts - 1))
+        xbmc.log("Cortana Chat: Failed to send {} message(s), retrying in {}s. Error: {}".format(len(group), delay, str(error)), xbmc.LOGERROR)
+        for entry in group:
+            entry['attempts'] = attempts
+            entry['next_try'] = time.time() + delay
+        save()
+
+# Drop messages the server rejected for good
+def _drop(group, error):
+    with _lock:
+        xbmc.log("Cortana Chat: Dropping {} undeliverable message(s). Error: {}".format(len(group), str(error)), xbmc.LOGERROR)
+        xbmc.executebuiltin("Notification(Cortana Chat, Failed to send message: " + str(error) + ", 2500)")
+        for entry in group:
+            _queue.remove(entry)
+        save()
+
+# Remove delivered messages from the queue
+def _sent(group):
+    with _lock:
+        for entry in group:
+            _queue.remove(entry)
+        _delivered[group[0]['convoId']] = time.time()
+        save()
+
+# Send a rejected batch one message at a time, so only the messages that still fail are dropped
+def _send_each(group):
+    for index, entry in enumerate(group):
+        try:
+            _send([entry])
+        except requests.exceptions.RequestException as e:
+            if _is_retryable(e):
+                _retry_later(group[index:], e)  # Keep the rest behind it so they stay in order
+                return
+            _drop([entry], e)
+            continue
+        _sent([entry])
+
+# Deliver queued messages until the queue is empty
+def _run():
+    while True:
+        with _lock:
+            if not _queue:
+                _state['worker'] = None
+                return
+            now = time.time()
+            groups = _due_groups(now)
+            _wake.clear()
+
+        for group in groups:
+            try:
+                _send(group)
+            except requests.exceptions.RequestException as e:
+                if _is_retryable(e):
+                    _retry_later(group, e)
+                elif len(group) > 1:
+                    _send_each(group)  # sendMessageBatch is all-or-nothing, so one bad message fails the whole batch
+                else:
+                    _drop(group, e)
+                continue
+            _sent(group)
+
+        # Sleep until the next retry is due or a new message is queued
+        with _lock:
+            heads = {}
+            for entry in _queue:
+                heads.setdefault(entry['convoId'], entry['next_try'])
+            next_try = min(heads.values()) if heads else 0
+        _wake.wait(max(0, min(RETRY_MAX, next_try - time.time())))
@@ -0,0 +1,34 @@
+# Cortana Chat v2.0 by faithvoid - https://github.com/faithvoid/script.cortanachatv2
+# Small JSON file helpers for the per-profile state files
+
+import os
+import json
+import xbmc
+
+# Load JSON from a file, returning default if it is missing or unreadable
+def load_json(path, default=None):
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            xbmc.log("Cortana Chat: Could not read {}: {}".format(path, str(e)), xbmc.LOGERROR)
+    return default
+
+# Replace a file with what write(f) puts in a temporary copy, only once that copy is fully written
+def replace_file(path, write):
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            write(f)
+        if os.path.exists(path):
+            os.remove(path)  # os.rename can't overwrite on the Xbox
+        os.rename(tmp_path, path)
+        return True
+    except (IOError, OSError) as e:
+        xbmc.log("Cortana Chat: Could not write {}: {}".format(path, str(e)), xbmc.LOGERROR)
+        return False
+
+# Save JSON to a file, replacing it only once the new copy is fully written
+def save_json(path, data):
+    return replace_file(path, lambda f: json.dump(data, f, separators=(',', ':')))
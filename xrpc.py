@@ -0,0 +1,291 @@
+# Cortana Chat v2.0 by faithvoid - https://github.com/faithvoid/script.cortanachatv2
+# Shared XRPC client for default.py and notifier.py
+
+import base64
+import json
+import threading
+import time
+import requests
+import xbmc
+import store
+from requests.adapters import HTTPAdapter
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+POOL_SIZE = 8  # Connections kept alive per host (BASE_URL, CHAT_URL), enough for the notifier's fetch workers
+TIMEOUT = 30  # Seconds before a request is abandoned
+REFRESH_MARGIN = 300  # Refresh the access token when it has less than this many seconds left
+PRIORITY_LOW = 0  # Work that can be dropped, e.g. feed prefetch and profile hydration
+PRIORITY_NORMAL = 1  # Interactive requests; raise RateLimited rather than block the UI thread
+PRIORITY_HIGH = 2  # Sending messages from the outbox worker, the only priority that waits for a window to reset
+RESERVE = {PRIORITY_LOW: 0.5, PRIORITY_NORMAL: 0.1, PRIORITY_HIGH: 0}  # Share of an endpoint group's window each priority leaves for the ones above it in the same group
+MAX_RATE_LIMIT_WAIT = 30  # Longest a high priority request waits for its window to reset before giving up
+DEFAULT_RETRY_AFTER = 60  # Seconds to hold off after a 429 that didn't say when to retry
+SESSION_FILE = xbmc.translatePath('special://home/userdata/profiles/{}/session.json'.format(xbmc.getInfoLabel('System.ProfileName')))
+
+_http_sessions = {}
+_buckets = {}  # Endpoint group -> {'limit', 'remaining', 'reset'} from the server's RateLimit headers
+_groups = {}  # (host, NSID) -> endpoint group the server last reported that method under
+_auth = {'jwt': None, 'headers': {}}
+_login = {'base_url': None, 'identifier': None, 'password': None}
+_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+
+# Raised instead of sending a request that the server's rate limit would reject
+class RateLimited(requests.exceptions.RequestException):
+    def __init__(self, message, retry_after):
+        requests.exceptions.RequestException.__init__(self, message)
+        self.retry_after = retry_after
+
+# Scheme and host of a URL
+def _host(url):
+    parsed = urlparse(url)
+    return parsed.scheme + '://' + parsed.netloc
+
+# Host and XRPC method (NSID) of a URL
+def _endpoint(url):
+    return _host(url), urlparse(url).path.rsplit('/', 1)[-1]
+
+# Rate limit group of a URL: the host plus the ratelimit-policy its method last reported, so methods sharing
+# a limit share a bucket while ones with their own (e.g. createSession) don't; a method not seen yet is its own group
+def _group(url):
+    endpoint = _endpoint(url)
+    return _groups.get(endpoint, endpoint)
+
+# Get the persistent requests.Session for the host of a URL
+def get_http(url):
+    host = _host(url)
+    with _lock:
+        http = _http_sessions.get(host)
+        if http is None:
+            http = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            http.mount(host, adapter)
+            _http_sessions[host] = http
+        return http
+
+# Build the Authorization header once per access token
+def auth_headers(session):
+    if not session or 'accessJwt' not in session:
+        return {}
+    jwt = session['accessJwt']
+    with _lock:
+        if _auth['jwt'] != jwt:
+            _auth['jwt'] = jwt
+            _auth['headers'] = {'Authorization': 'Bearer ' + jwt}
+        return _auth['headers']
+
+# Merge the auth header with any per-call headers
+def _headers(session, headers):
+    merged = dict(auth_headers(session))
+    if headers:
+        merged.update(headers)
+    return merged
+
+# Read the expiry time out of a JWT without verifying it
+def jwt_expiry(token):
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload.encode('ascii')).decode('utf-8')).get('exp', 0)
+    except (IndexError, ValueError, TypeError, AttributeError):
+        return None
+
+# Check whether an access token is close enough to expiry to rotate
+def is_expiring(session):
+    expiry = jwt_expiry(session.get('accessJwt', ''))
+    if expiry is None:
+        return False  # Unreadable token, rely on the 401 retry instead
+    return expiry - time.time() < REFRESH_MARGIN
+
+# Load the session saved by either default.py or notifier.py
+def load_session(identifier):
+    saved = store.load_json(SESSION_FILE, {})
+    if saved.get('identifier') == identifier and saved.get('session', {}).get('refreshJwt'):
+        return saved['session']
+    return None
+
+# Save the session so the UI and the notifier share one login
+def save_session(session):
+    store.save_json(SESSION_FILE, {'identifier': _login['identifier'], 'session': session})
+
+# Log in with the app password via createSession
+def create_session(base_url, identifier, password):
+    response = post(None, base_url + 'com.atproto.server.createSession', json={'identifier': identifier, 'password': password})
+    response.raise_for_status()
+    session = response.json()
+    save_session(session)
+    return session
+
+# Resume the saved session, falling back to createSession only when it can't be refreshed
+def resume_session(base_url, identifier, password):
+    _login.update({'base_url': base_url, 'identifier': identifier, 'password': password})
+    session = load_session(identifier)
+    if session:
+        if not is_expiring(session) or refresh_session(session):
+            return session
+    return create_session(base_url, identifier, password)
+
+# Rotate the tokens with refreshSession, updating the session dict in place
+def refresh_session(session, stale_jwt=None):
+    with _refresh_lock:
+        # Another thread already rotated the tokens while we waited
+        if stale_jwt and session.get('accessJwt') != stale_jwt:
+            return True
+
+        # The other script may already have rotated them; adopt its copy
+        saved = load_session(_login['identifier'])
+        if saved and saved.get('accessJwt') != session.get('accessJwt') and not is_expiring(saved):
+            session.update(saved)
+            return True
+
+        if _login['base_url'] is None:
+            return False
+        url = _login['base_url'] + 'com.atproto.server.refreshSession'
+        headers = {'Authorization': 'Bearer ' + session.get('refreshJwt', '')}
+        try:
+            response = get_http(url).post(url, headers=headers, timeout=TIMEOUT)
+            response.raise_for_status()
+            session.update(response.json())
+            save_session(session)
+            xbmc.log("Cortana Chat: Session refreshed", xbmc.LOGINFO)
+            return True
+        except requests.exceptions.RequestException as e:
+            xbmc.log("Cortana Chat: Session refresh failed. Error: {}".format(str(e)), xbmc.LOGERROR)
+
+        # The refresh token is dead too, so log in again if we still have the password
+        if _login['password']:
+            try:
+                session.update(create_session(_login['base_url'], _login['identifier'], _login['password']))
+                return True
+            except requests.exceptions.RequestException as e:
+                xbmc.log("Cortana Chat: Re-login failed. Error: {}".format(str(e)), xbmc.LOGERROR)
+        return False
+
+# Check if a response was rejected because the access token expired
+def is_auth_error(response):
+    if response.status_code == 401:
+        return True
+    if response.status_code == 400:
+        try:
+            return response.json().get('error') in ('ExpiredToken', 'InvalidToken')
+        except ValueError:
+            return False
+    return False
+
+# Take a token from the endpoint group's bucket; lower priorities stop early to leave the rest of the window to higher ones
+def _acquire(url, priority):
+    while True:
+        with _lock:
+            group = _group(url)
+            bucket = _buckets.get(group)
+            now = time.time()
+            if bucket is None or now >= bucket['reset']:
+                _buckets.pop(group, None)  # New window, unknown until the next response says otherwise
+                return
+            if bucket['remaining'] > bucket['limit'] * RESERVE[priority]:
+                bucket['remaining'] -= 1  # Count it now so concurrent requests don't overshoot
+                return
+            wait = bucket['reset'] - now
+        if priority != PRIORITY_HIGH or wait > MAX_RATE_LIMIT_WAIT:
+            raise RateLimited("Rate limit reached for {}, resets in {:.0f}s".format(' '.join(group), wait), wait)
+        time.sleep(wait)
+
+# Seconds until a RateLimit reset header value, which may be a delta or an epoch time
+def reset_delay(value):
+    value = float(value)
+    return value - time.time() if value > 1000000000 else value
+
+# Update the endpoint group's bucket from the RateLimit headers of a response, closing it after a 429
+def _update_bucket(url, response):
+    headers = response.headers
+    try:
+        limit = int(headers['ratelimit-limit'])
+        remaining = int(headers['ratelimit-remaining'])
+        delay = reset_delay(headers['ratelimit-reset'])
+    except (KeyError, ValueError, TypeError):
+        limit = remaining = delay = None
+
+    with _lock:
+        if headers.get('ratelimit-policy'):
+            _groups[_endpoint(url)] = (_host(url), headers['ratelimit-policy'])
+        group = _group(url)
+
+    if response.status_code == 429:
+        try:
+            delay = float(headers['Retry-After'])
+        except (KeyError, ValueError, TypeError):
+            delay = delay or DEFAULT_RETRY_AFTER
+        limit, remaining = limit or 1, 0
+        xbmc.log("Cortana Chat: Rate limited on {}, holding off for {:.0f}s".format(' '.join(group), delay), xbmc.LOGERROR)
+    elif limit is None:
+        return
+
+    with _lock:
+        _buckets[group] = {'limit': limit, 'remaining': remaining, 'reset': time.time() + max(0, delay)}
+
+# Send one request through the rate limit bucket of its endpoint group
+def _send(method, session, url, headers, priority, kwargs):
+    _acquire(url, priority)
+    response = get_http(url).request(method, url, headers=_headers(session, headers), timeout=TIMEOUT, **kwargs)
+    _update_bucket(url, response)
+    return response
+
+# Send a request, rotating the session before it expires or after a 401
+def _request(method, session, url, priority=PRIORITY_NORMAL, **kwargs):
+    headers = kwargs.pop('headers', None)
+    if session and is_expiring(session):
+        refresh_session(session, session.get('accessJwt'))
+    jwt = session.get('accessJwt') if session else None
+    response = _send(method, session, url, headers, priority, kwargs)
+    if session and is_auth_error(response) and refresh_session(session, jwt):
+        response = _send(method, session, url, headers, priority, kwargs)
+    if response.status_code == 429 and priority == PRIORITY_HIGH:
+        response = _send(method, session, url, headers, priority, kwargs)  # Waits out a short window, raises RateLimited otherwise
+    return response
+
+# GET an XRPC method over the pooled connection for its host
+def get(session, url, params=None, headers=None, priority=PRIORITY_NORMAL):
+    return _request('GET', session, url, priority, params=params, headers=headers)
+
+# POST to an XRPC method over the pooled connection for its host
+def post(session, url, json=None, data=None, headers=None, priority=PRIORITY_NORMAL):
+    return _request('POST', session, url, priority, json=json, data=data, headers=headers)
+
+# Yield pages of items from a cursor-paginated XRPC method, stopping after limit items if given
+def iter_pages(session, url, key, params=None, limit=None, page_size=100, priority=PRIORITY_NORMAL):
+    cursor = None
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page_params = dict(params or {})
+        page_params['limit'] = page_size if remaining is None else min(page_size, remaining)
+        if cursor:
+            page_params['cursor'] = cursor
+        response = get(session, url, params=page_params, priority=priority)
+        response.raise_for_status()
+        data = response.json()
+        items = data.get(key, [])
+        if remaining is not None:
+            items = items[:remaining]
+            remaining -= len(items)
+        if items:
+            yield items
+        cursor = data.get('cursor')
+        if not cursor or not items:
+            return
+
+# Yield items one at a time from a cursor-paginated XRPC method
+def paginate(session, url, key, params=None, limit=None, page_size=100, priority=PRIORITY_NORMAL):
+    for page in iter_pages(session, url, key, params, limit, page_size, priority):
+        for item in page:
+            yield item
+
+# Close all pooled connections
+def close():
+    with _lock:
+        for http in _http_sessions.values():
+            http.close()
+        _http_sessions.clear()